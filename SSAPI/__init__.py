@@ -1,29 +1,48 @@
 from flask import Flask, request, jsonify
 from SSAPI.config import Config
 from flask_restplus import Resource, Api
-from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
 from SSAPI.config import app_config
+from SSAPI import (database, hashing, instrumentation, json_backend,
+                   metrics, slow_queries)
 import flask_praetorian
 import os
 import sqlalchemy
 
 
-guard = flask_praetorian.Praetorian()
+guard = hashing.PooledPraetorian()
 config_name = os.getenv('APP_SETTINGS')
 
 app = Flask(__name__)                  # Create a Flask WSGI application
 app.config.from_object(app_config[config_name])    # Pull in our configuration
-CORS(app)                              # Allow Cross-Origin
+CORS(app, expose_headers=['X-Next-Cursor',  # Allow Cross-Origin
+                          'X-Primary-Until'])
 api = Api(app)                         # Create a Flask-RESTPlus API
-db = SQLAlchemy(app)                   # Create our SQLAlchemy DB
+database.init_app(app)                 # Pool options and SQLite pragmas
+db = database.RoutingSQLAlchemy(app)   # Create our SQLAlchemy DB
+json_backend.init_app(app)             # Pick our JSON encoder
+instrumentation.init_app(app)          # Opt-in per-request timings
+slow_queries.init_app(app)             # Log slow statements with their plan
+hasher = hashing.PasswordHasher(guard, app.config['PASSWORD_HASH_WORKERS'],
+                                app.config['PASSWORD_HASH_QUEUE_DEPTH'],
+                                app.config['PASSWORD_HASH_RETRY_AFTER'])
+guard.hasher = hasher                  # Hash passwords off the request thread
+metrics.init_app(app, hasher)          # Request counters on /metrics
+
+
+@api.representation('application/json')
+def output_json(data, code, headers=None):
+    return json_backend.make_json_response(data, code, headers)
+
 
 from SSAPI.models import *
 from SSAPI.usermgmt_views import *
 from SSAPI.scrimmage_views import *
 from SSAPI.invite_views import *
+from SSAPI import invites
 
 guard.init_app(app, User)
+invites.init_app(app)                  # Invite delivery and resends
 
 
 # Setup our error handlers
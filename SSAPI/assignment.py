@@ -0,0 +1,253 @@
+from collections import defaultdict, deque
+import heapq
+from SSAPI import db
+from SSAPI.models import (Scrimmage, ScrimmageInvite, UserRole, advisors,
+                          presenters)
+
+# Pair sources, best first. Declined invites never become pairs.
+ACCEPTED, PENDING, FILL = 0, 1, 2
+SOURCE_NAMES = ('accepted', 'pending', 'fill')
+SOURCE_WEIGHTS = (4.0, 2.0, 1.0)
+# Spread advisors out: each scrimmage they already advise costs this much
+LOAD_PENALTY = 0.5
+# ...and favour the emptiest scrimmages
+EMPTY_BONUS = 1.0
+
+
+class Problem():
+    """ Open seats, free advisors and candidate pairs read from the database
+
+    seats maps scrimmage id to open seats, capacity maps advisor id to how
+    many more scrimmages they may take, fill is each scrimmage's share of
+    max_advisors already taken and load how many open scrimmages an
+    advisor already advises. Pairs are (advisor ids, scrimmage ids,
+    sources) lists from the invites; excluded holds (advisor, scrimmage)
+    pairs that may never be assigned.
+    """
+
+    def __init__(self, max_per_advisor):
+        open_rows = db.session.query(
+            Scrimmage.id, Scrimmage.max_advisors).filter(
+            db.or_(Scrimmage.scrimmage_complete.is_(None),
+                   Scrimmage.scrimmage_complete == False)).all()  # noqa: E712
+        max_advisors = {sid: limit or 0 for sid, limit in open_rows}
+
+        self.load = defaultdict(int)
+        self.excluded = set()
+        taken = defaultdict(int)
+        for table in (advisors, presenters):
+            rows = db.session.query(table.c.user_id, table.c.scrimmage_id)
+            for user_id, scrimmage_id in rows:
+                if scrimmage_id not in max_advisors:
+                    continue
+                self.excluded.add((user_id, scrimmage_id))
+                if table is advisors:
+                    self.load[user_id] += 1
+                    taken[scrimmage_id] += 1
+
+        self.seats = {sid: limit - taken[sid]
+                      for sid, limit in max_advisors.items()
+                      if limit > taken[sid]}
+        self.fill = {sid: taken[sid] / float(max_advisors[sid])
+                     for sid in self.seats}
+
+        self.capacity = {}
+        for (user_id,) in db.session.query(UserRole.user_id).filter(
+                UserRole.name == 'advisor'):
+            left = max_per_advisor - self.load[user_id]
+            if left > 0:
+                self.capacity[user_id] = left
+
+        self.pair_advisors, self.pair_scrimmages, self.pair_sources = \
+            [], [], []
+        rows = db.session.query(ScrimmageInvite.advisor_id,
+                                ScrimmageInvite.scrimmage_id,
+                                ScrimmageInvite.accepted,
+                                ScrimmageInvite.responded)
+        for advisor_id, scrimmage_id, accepted, responded in rows:
+            if responded is not None and not accepted:
+                self.excluded.add((advisor_id, scrimmage_id))
+            elif (advisor_id in self.capacity and
+                  scrimmage_id in self.seats and
+                  (advisor_id, scrimmage_id) not in self.excluded):
+                self.pair_advisors.append(advisor_id)
+                self.pair_scrimmages.append(scrimmage_id)
+                self.pair_sources.append(ACCEPTED if accepted else PENDING)
+
+
+def score_pairs(advisor_ids, scrimmage_ids, sources, load, fill):
+    """ Scores every candidate pair """
+    return [SOURCE_WEIGHTS[source] - LOAD_PENALTY * load.get(a, 0) +
+            EMPTY_BONUS * (1.0 - fill[s])
+            for a, s, source in zip(advisor_ids, scrimmage_ids, sources)]
+
+
+class Matching():
+    """ Capacity respecting advisor to scrimmage matching
+
+    Pairs are first taken greedily by descending score, then Hopcroft-Karp
+    style augmenting paths (breadth-first layering, depth-first search)
+    raise the number of assignments to the maximum flow. An augmenting path
+    only ever moves an assigned advisor to another of its candidate
+    scrimmages, so nobody placed by the greedy pass is dropped.
+    """
+
+    def __init__(self, capacity, seats):
+        self.capacity = dict(capacity)
+        self.seats = dict(seats)
+        self.adjacent = defaultdict(list)
+        self.members = defaultdict(list)   # scrimmage -> advisors
+        self.assigned = defaultdict(set)   # advisor -> scrimmages
+        self.scores = {}
+
+    def add_pairs(self, advisor_ids, scrimmage_ids, scores):
+        order = sorted(range(len(scores)), key=scores.__getitem__,
+                       reverse=True)
+        for i in order:
+            a, s = advisor_ids[i], scrimmage_ids[i]
+            self.scores[(a, s)] = scores[i]
+            self.adjacent[a].append(s)
+            if self.capacity[a] > 0 and self.seats[s] > 0:
+                self.assign(a, s)
+
+    def assign(self, a, s):
+        self.capacity[a] -= 1
+        self.seats[s] -= 1
+        self.members[s].append(a)
+        self.assigned[a].add(s)
+
+    def moves(self, a):
+        """ (scrimmage, advisor to displace or None for a free seat) """
+        for s in self.adjacent[a]:
+            if s in self.assigned[a]:
+                continue
+            if self.seats[s] > 0:
+                yield s, None
+            for other in list(self.members[s]):
+                yield s, other
+
+    def layers(self, roots):
+        dist = dict.fromkeys(roots, 0)
+        queue = deque(roots)
+        while queue:
+            a = queue.popleft()
+            for s, other in self.moves(a):
+                if other is not None and other not in dist:
+                    dist[other] = dist[a] + 1
+                    queue.append(other)
+        return dist
+
+    def augment(self, root, dist):
+        chosen = []
+        stack = [(root, self.moves(root))]
+        while stack:
+            a, moves = stack[-1]
+            for s, other in moves:
+                if other is None:
+                    for prev, seat, moved in chosen:
+                        self.members[seat].remove(moved)
+                        self.assigned[moved].discard(seat)
+                        self.members[seat].append(prev)
+                        self.assigned[prev].add(seat)
+                    self.assign(a, s)
+                    # Advisors along the path swap one scrimmage for
+                    # another; only the root ends up with one more
+                    self.capacity[a] += 1
+                    self.capacity[root] -= 1
+                    return True
+                if dist.get(other) == dist[a] + 1:
+                    chosen.append((a, s, other))
+                    stack.append((other, self.moves(other)))
+                    break
+            else:
+                dist[a] = None
+                stack.pop()
+                if chosen:
+                    chosen.pop()
+        return False
+
+    def maximize(self):
+        while True:
+            roots = [a for a, left in self.capacity.items()
+                     if left > 0 and self.adjacent[a]]
+            if not roots:
+                return
+            dist = self.layers(roots)
+            grown = False
+            for root in roots:
+                while self.capacity[root] > 0 and dist.get(root) == 0:
+                    if not self.augment(root, dist):
+                        break
+                    grown = True
+            if not grown:
+                return
+
+    def fill(self, excluded, fill_ratio, load):
+        """ Gives leftover advisors the emptiest scrimmages they may join """
+        heap = [(fill_ratio[s], s) for s, left in self.seats.items()
+                if left > 0]
+        heapq.heapify(heap)
+        free = sorted((a for a, left in self.capacity.items() if left > 0),
+                      key=lambda a: (load.get(a, 0), a))
+        filled = []
+        for a in free:
+            skipped = []
+            while heap and self.capacity[a] > 0:
+                ratio, s = heapq.heappop(heap)
+                if (a, s) in excluded or s in self.assigned[a]:
+                    skipped.append((ratio, s))
+                    continue
+                self.assign(a, s)
+                filled.append((a, s))
+                if self.seats[s] > 0:
+                    skipped.append((ratio, s))
+            for entry in skipped:
+                heapq.heappush(heap, entry)
+        return filled
+
+    def pairs(self):
+        return sorted((s, a) for a, scrimmages in self.assigned.items()
+                      for s in scrimmages)
+
+
+def solve(max_per_advisor, fill=False):
+    """ Works out advisor assignments for every open scrimmage seat """
+    problem = Problem(max_per_advisor)
+    matching = Matching(problem.capacity, problem.seats)
+    scores = score_pairs(problem.pair_advisors, problem.pair_scrimmages,
+                         problem.pair_sources, problem.load, problem.fill)
+    matching.add_pairs(problem.pair_advisors, problem.pair_scrimmages, scores)
+    matching.maximize()
+
+    sources = dict(zip(zip(problem.pair_advisors, problem.pair_scrimmages),
+                       problem.pair_sources))
+    if fill:
+        filled = matching.fill(problem.excluded, problem.fill, problem.load)
+        fill_scores = score_pairs([a for a, s in filled],
+                                  [s for a, s in filled],
+                                  [FILL] * len(filled), problem.load,
+                                  problem.fill)
+        for pair, score in zip(filled, fill_scores):
+            matching.scores[pair] = score
+            sources[pair] = FILL
+
+    assignments = [{'scrimmage_id': s, 'advisor_id': a,
+                    'score': round(matching.scores[(a, s)], 3),
+                    'source': SOURCE_NAMES[sources[(a, s)]]}
+                   for s, a in matching.pairs()]
+    return {'assignments': assignments,
+            'open_seats': sum(matching.seats.values()),
+            'unassigned_advisors': sum(1 for left in
+                                       matching.capacity.values() if left)}
+
+
+def apply(assignments):
+    """ Adds the assigned advisors whose seats are still free
+
+    Each pair goes through Scrimmage.add_advisor's conditional INSERT, so
+    joins committed since solve() cannot overfill max_advisors and a pair
+    that already exists is not inserted twice. Returns the assignments
+    skipped for either reason. The caller commits.
+    """
+    return [a for a in assignments
+            if not Scrimmage.add_advisor(a['scrimmage_id'], a['advisor_id'])]
@@ -0,0 +1,49 @@
+import calendar
+from flask import current_app, request
+
+
+def make_etag(version, updated_at):
+    """ Strong validator for a row's (version, updated_at) pair
+
+    updated_at is folded in so a row re-created under a reused id does not
+    repeat the ETag of the one that was deleted.
+    """
+    if updated_at is None:
+        return str(version)
+    stamp = calendar.timegm(updated_at.utctimetuple()) * 1000000
+    return '%d.%d' % (version, stamp + updated_at.microsecond)
+
+
+def is_not_modified(etag, updated_at):
+    """ Evaluates If-None-Match, then If-Modified-Since, for this request """
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since and updated_at is not None:
+        return updated_at.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def set_validators(resp, etag, updated_at):
+    resp.set_etag(etag)
+    if updated_at is not None:
+        resp.last_modified = updated_at
+    return resp
+
+
+def conditional_get(model, id, load):
+    """ Answers a GET for row id of model, honouring conditional headers
+
+    Only the version columns are read to decide on a 304; load(), which
+    builds the full response, runs when the client's copy is stale.
+    """
+    row = model.query.with_entities(model.version, model.updated_at).filter(
+        model.id == id).first()
+    if row is None:
+        return load()
+
+    etag = make_etag(*row)
+    if is_not_modified(etag, row.updated_at):
+        resp = current_app.response_class(status=304)
+    else:
+        resp = load()
+    return set_validators(resp, etag, row.updated_at)
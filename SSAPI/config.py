@@ -1,15 +1,96 @@
 import os
 
 
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
 class Config():
     DEBUG = False
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'Scr1mmag32w!n'
-    SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/test.db'
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('DATABASE_URL') or
+                               'sqlite:////tmp/test.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+    # Connection pool, see SSAPI.database.engine_options
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 5)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 10)
+    DB_POOL_PRE_PING = True
+    DB_POOL_RECYCLE = env_int('DB_POOL_RECYCLE', 1800)
+
+    # Read replicas for GET handlers marked reads_from_replica, used
+    # round-robin. After a write a user reads from the primary for
+    # READ_YOUR_WRITES_SECONDS, carried by a signed cookie and
+    # X-Primary-Until header so every worker honours it.
+    SQLALCHEMY_REPLICA_URIS = [
+        uri for uri in os.environ.get('DATABASE_REPLICA_URLS', '').split(',')
+        if uri]
+    READ_YOUR_WRITES_SECONDS = env_int('READ_YOUR_WRITES_SECONDS', 10)
+
+    # Applied to every new SQLite connection. WAL lets readers run alongside
+    # a writer, and busy_timeout makes writers wait instead of failing with
+    # "database is locked".
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': env_int('SQLITE_BUSY_TIMEOUT', 5000),
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -16000,  # KiB
+    }
+
     JWT_ACCESS_LIFESPAN = {'hours': 24}
     JWT_REFRESH_LIFESPAN = {'days': 30}
 
+    # Processes used to hash and verify passwords; 0 hashes inline. Once
+    # workers + queue depth requests are hashing, logins get a 503.
+    PASSWORD_HASH_WORKERS = env_int('PASSWORD_HASH_WORKERS', 2)
+    PASSWORD_HASH_QUEUE_DEPTH = env_int('PASSWORD_HASH_QUEUE_DEPTH', 32)
+    PASSWORD_HASH_RETRY_AFTER = 1  # seconds
+
+    MAX_PAGE_SIZE = 500
+    STREAM_BATCH_SIZE = 500
+    SEARCH_PAGE_SIZE = 20  # /Scrimmages/Search results without ?limit
+
+    # Adds a Server-Timing header and a JSON log line (logger
+    # SSAPI.instrumentation) with SQL and serialization timings per request
+    INSTRUMENTATION = os.environ.get('SSAPI_INSTRUMENTATION') == '1'
+
+    # Statements slower than this many milliseconds are logged (logger
+    # SSAPI.slow_queries) with their parameter types, view and query plan;
+    # 0 disables the log
+    SLOW_QUERY_MS = env_int('SLOW_QUERY_MS', 0)
+
+    # Invites are delivered through INVITE_DELIVERY ('memory' or
+    # 'file:<path>') and resent every INVITE_RESEND_SECONDS until answered.
+    # Set INVITE_SCHEDULER=1 in exactly one process to run the sender,
+    # which starts with that process's first request; it looks for invites
+    # created by other processes every INVITE_POLL_SECONDS.
+    INVITE_DELIVERY = os.environ.get('INVITE_DELIVERY') or 'memory'
+    INVITE_RESEND_SECONDS = env_int('INVITE_RESEND_SECONDS', 86400)
+    INVITE_POLL_SECONDS = env_int('INVITE_POLL_SECONDS', 10)
+    INVITE_BATCH_SIZE = env_int('INVITE_BATCH_SIZE', 100)
+    INVITE_SCHEDULER = os.environ.get('INVITE_SCHEDULER') == '1'
+
+    # Length of a scrimmage whose schedule gives only its start
+    SCRIMMAGE_DEFAULT_MINUTES = env_int('SCRIMMAGE_DEFAULT_MINUTES', 60)
+
+    # Most open scrimmages /Scrimmages/Assign gives one advisor
+    ASSIGNMENT_MAX_PER_ADVISOR = env_int('ASSIGNMENT_MAX_PER_ADVISOR', 1)
+
+    # Directory shared by all worker processes so /metrics covers the whole
+    # server; unset keeps metrics per process
+    METRICS_DIR = os.environ.get('METRICS_DIR')
+    METRICS_FLUSH_SECONDS = 1
+
+    # 'auto' uses orjson when it is installed, else Flask's stdlib encoder
+    JSON_BACKEND = os.environ.get('JSON_BACKEND') or 'auto'
+
+    # Process level cache of authenticated users keyed by the JWT id. Each
+    # worker has its own copy, so keep the TTL short; 0 disables it.
+    IDENTITY_CACHE_TTL = 0
+    IDENTITY_CACHE_SIZE = 1024
+
 
 class DevelopmentConfig(Config):
     DEBUG = True
@@ -17,13 +98,16 @@ class DevelopmentConfig(Config):
 
 class TestingConfig(Config):
     TESTING = True
-    SQLALCHEMY_DATABASE_URI = 'sqlite:////tmp/testing.db'
+    SQLALCHEMY_DATABASE_URI = (os.environ.get('TEST_DATABASE_URL') or
+                               'sqlite:////tmp/testing.db')
     DEBUG = True
 
 
 class ProductionConfig(Config):
     TESTING = False
     DEBUG = False
+    DB_POOL_SIZE = env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = env_int('DB_MAX_OVERFLOW', 20)
 
 app_config = {
     'development': DevelopmentConfig,
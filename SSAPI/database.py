@@ -0,0 +1,197 @@
+import functools
+import itertools
+import sqlite3
+import threading
+import time
+from flask import (current_app, g, has_app_context, has_request_context,
+                   request)
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+import flask_praetorian
+from flask_praetorian.utilities import app_context_has_jwt_data
+from itsdangerous import BadSignature, Signer
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+
+
+def engine_options(config, uri=None):
+    """ create_engine() pool options for uri built from the DB_* settings """
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    options = {
+        'pool_pre_ping': config['DB_POOL_PRE_PING'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+    }
+    if url.drivername.startswith('sqlite'):
+        if url.database in (None, '', ':memory:'):
+            # Flask-SQLAlchemy shares one connection for in-memory databases
+            return {}
+        # Reuse connections (and their pragmas) across requests and threads
+        # instead of SQLAlchemy's NullPool default for SQLite files
+        options['poolclass'] = QueuePool
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+def apply_sqlite_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA %s = %s' % (name, value))
+    cursor.close()
+
+
+def init_app(app):
+    """ Sets SQLALCHEMY_ENGINE_OPTIONS and the SQLite pragmas for app
+
+    Must run before SQLAlchemy(app) creates the engine. Options already set
+    in SQLALCHEMY_ENGINE_OPTIONS take precedence over the DB_* settings.
+    """
+    options = engine_options(app.config)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {})
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+
+    pragmas = app.config['SQLITE_PRAGMAS']
+
+    @event.listens_for(Engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            apply_sqlite_pragmas(dbapi_connection, pragmas)
+
+
+class RoutingSession(SignallingSession):
+    """ Session that sends reads to a replica when the request picked one
+
+    Flushes and INSERT/UPDATE/DELETE statements always go to the primary.
+    Statements executed directly, like bulk table.insert() calls, open the
+    writer's read-your-writes window here, as flushes do in record_flush.
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            record_write(self)
+            return SignallingSession.get_bind(self, mapper, clause)
+        replica = g.get('db_replica') if has_app_context() else None
+        if replica is not None and not self._flushing:
+            return replica
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy with round-robin read replicas
+
+    Replica URIs come from SQLALCHEMY_REPLICA_URIS. Handlers opt in with
+    reads_from_replica; everything else uses the primary engine.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._replica_engines = {}
+        self._replica_lock = threading.Lock()
+        self._replica_counter = itertools.count()
+        SQLAlchemy.__init__(self, *args, **kwargs)
+
+    def init_app(self, app):
+        SQLAlchemy.init_app(self, app)
+        app.after_request(send_primary_until)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def get_replica_engine(self, app, uri):
+        with self._replica_lock:
+            engine = self._replica_engines.get(uri)
+            if engine is None:
+                engine = create_engine(uri, **engine_options(app.config, uri))
+                self._replica_engines[uri] = engine
+            return engine
+
+    def choose_replica(self, app):
+        """ Next replica engine in round-robin order, or None if none """
+        uris = app.config['SQLALCHEMY_REPLICA_URIS']
+        if not uris:
+            return None
+        uri = uris[next(self._replica_counter) % len(uris)]
+        return self.get_replica_engine(app, uri)
+
+
+def current_jwt_user_id():
+    if app_context_has_jwt_data():
+        return flask_praetorian.current_user_id()
+    return None
+
+
+# Users who wrote recently read from the primary for a while, so they see
+# their own changes despite replication lag. The window travels with the
+# client, as a signed "<user id>:<until>" in this cookie and response header
+# (either may be sent back), so it holds whichever worker serves the read.
+PRIMARY_UNTIL_COOKIE = 'ssapi_primary_until'
+PRIMARY_UNTIL_HEADER = 'X-Primary-Until'
+
+
+def primary_until_signer(app):
+    return Signer(app.secret_key, salt='ssapi-read-your-writes')
+
+
+def reads_primary(user_id):
+    """ Whether the request carries user_id's unexpired write window """
+    value = (request.headers.get(PRIMARY_UNTIL_HEADER) or
+             request.cookies.get(PRIMARY_UNTIL_COOKIE))
+    if user_id is None or not value:
+        return False
+    try:
+        marked_id, until = primary_until_signer(current_app).unsign(
+            value).decode().split(':')
+        return int(marked_id) == user_id and int(until) > time.time()
+    except (BadSignature, ValueError):
+        return False
+
+
+def reads_from_replica(method):
+    """ Runs a GET handler against a read replica, when that is safe
+
+    Apply below auth_required so the token has been checked. Users who
+    wrote within READ_YOUR_WRITES_SECONDS stay on the primary.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        db = current_app.extensions['sqlalchemy'].db
+        if (request.method == 'GET' and
+                not reads_primary(current_jwt_user_id())):
+            g.db_replica = db.choose_replica(current_app)
+        return method(*args, **kwargs)
+    return wrapper
+
+
+def record_write(session):
+    """ Starts the read-your-writes window of the user making a change """
+    if has_request_context():
+        user_id = current_jwt_user_id()
+        if user_id is not None:
+            g.primary_until = user_id
+
+
+def send_primary_until(response):
+    """ Hands a writer its read-your-writes window """
+    user_id = g.get('primary_until')
+    seconds = current_app.config['READ_YOUR_WRITES_SECONDS']
+    if user_id is not None and seconds > 0:
+        until = int(time.time()) + seconds
+        value = primary_until_signer(current_app).sign(
+            '%d:%d' % (user_id, until)).decode()
+        response.set_cookie(PRIMARY_UNTIL_COOKIE, value, max_age=seconds,
+                            httponly=True)
+        response.headers[PRIMARY_UNTIL_HEADER] = value
+    return response
+
+
+@event.listens_for(RoutingSession, 'after_flush')
+def record_flush(session, flush_context):
+    record_write(session)
+
+
+@event.listens_for(RoutingSession, 'after_bulk_update')
+@event.listens_for(RoutingSession, 'after_bulk_delete')
+def record_bulk_write(context):
+    record_write(context.session)
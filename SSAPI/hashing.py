@@ -0,0 +1,199 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import functools
+import logging
+import multiprocessing
+import threading
+import flask_praetorian
+from passlib.context import CryptContext
+from werkzeug.exceptions import ServiceUnavailable
+from SSAPI.json_backend import make_json_response
+
+logger = logging.getLogger(__name__)
+
+# Workers are started from request threads, so they must not be plain forks
+# that could inherit a lock another thread holds; the forkserver forks them
+# from a clean single threaded process instead
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context('forkserver')
+else:  # pragma: no cover - Windows
+    _mp_context = multiprocessing.get_context('spawn')
+
+# Set in each pool worker by _init_worker
+_worker_ctx = None
+_worker_scheme = None
+
+
+def _init_worker(ctx_config, scheme):
+    global _worker_ctx, _worker_scheme
+    _worker_ctx = CryptContext.from_string(ctx_config)
+    _worker_scheme = scheme
+
+
+def _hash_password(raw_password):
+    return _worker_ctx.hash(raw_password, scheme=_worker_scheme)
+
+
+def _verify_password(raw_password, hashed_password):
+    return _worker_ctx.verify(raw_password, hashed_password)
+
+
+class HashQueueFull(ServiceUnavailable):
+    """ Raised when every hashing slot, running or queued, is taken """
+    description = "Too many logins in progress, retry shortly"
+
+    def __init__(self, retry_after):
+        ServiceUnavailable.__init__(self)
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None):
+        headers = ServiceUnavailable.get_headers(self, environ)
+        headers.append(('Retry-After', str(self.retry_after)))
+        return headers
+
+
+def sheds_hash_load(method):
+    """ Answers HashQueueFull with a JSON 503 and Retry-After directly
+
+    Shedding load is expected under a login storm, so this skips the error
+    log (and traceback) flask-restplus writes for every 5xx it handles.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except HashQueueFull as e:
+            return make_json_response({"message": e.description}, e.code,
+                                      {'Retry-After': str(e.retry_after)})
+    return wrapper
+
+
+class PasswordHasher():
+    """ Hashes and verifies passwords with praetorian's settings on a
+    process pool, so the deliberately slow hashing never holds the GIL of
+    the request threads.
+
+    At most workers + queue_depth single hash/verify calls may be running
+    or waiting; beyond that HashQueueFull is raised immediately instead of
+    queueing more work. The pool is started on first use and replaced when
+    a worker dies, and with workers set to 0 everything is done inline on
+    the calling thread.
+    """
+
+    def __init__(self, guard, workers, queue_depth=0, retry_after=1):
+        self.guard = guard
+        self.workers = workers
+        self.retry_after = retry_after
+        self.capacity = workers + queue_depth
+        self._slots = threading.BoundedSemaphore(max(self.capacity, 1))
+        self._pending = 0
+        self._executor = None
+        self._lock = threading.Lock()
+
+    @property
+    def executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=_mp_context,
+                    initializer=_init_worker,
+                    initargs=(self.guard.pwd_ctx.to_string(),
+                              self.guard.hash_scheme))
+            return self._executor
+
+    def _discard(self, broken):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+    def _on_pool(self, work):
+        """ Returns work(executor), retried once on a new pool if a worker
+        died; HashQueueFull if the new pool breaks too
+        """
+        for _ in range(2):
+            executor = self.executor
+            try:
+                return work(executor)
+            except BrokenProcessPool:
+                logger.warning("Password hashing pool broke, restarting it")
+                self._discard(executor)
+        raise HashQueueFull(self.retry_after)
+
+    @property
+    def pending(self):
+        """ Number of hash/verify calls running or waiting for a worker """
+        return self._pending
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashQueueFull(self.retry_after)
+        with self._lock:
+            self._pending += 1
+        try:
+            return self._on_pool(
+                lambda executor: executor.submit(func, *args).result())
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._slots.release()
+
+    def hash(self, raw_password):
+        if not self.workers:
+            return self.guard.pwd_ctx.hash(raw_password,
+                                           scheme=self.guard.hash_scheme)
+        return self._run(_hash_password, raw_password)
+
+    def verify(self, raw_password, hashed_password):
+        if not self.workers:
+            return self.guard.pwd_ctx.verify(raw_password, hashed_password)
+        return self._run(_verify_password, raw_password, hashed_password)
+
+    def hash_many(self, passwords):
+        """ Hashes passwords in parallel, returning hashes in input order
+
+        The batch runs in chunks holding one slot per password and at most
+        one per worker, so it never queues more than the pool can run and
+        leaves the queue to logins. Each chunk waits up to retry_after for
+        its first slot, then raises HashQueueFull.
+        """
+        passwords = list(passwords)
+        if not self.workers or len(passwords) < 2:
+            return [self.hash(p) for p in passwords]
+        hashes = []
+        while len(hashes) < len(passwords):
+            if not self._slots.acquire(timeout=self.retry_after):
+                raise HashQueueFull(self.retry_after)
+            taken = 1
+            wanted = min(self.workers, len(passwords) - len(hashes))
+            while taken < wanted and self._slots.acquire(blocking=False):
+                taken += 1
+            with self._lock:
+                self._pending += taken
+            try:
+                chunk = passwords[len(hashes):len(hashes) + taken]
+                hashes += self._on_pool(
+                    lambda executor: list(executor.map(_hash_password, chunk)))
+            finally:
+                with self._lock:
+                    self._pending -= taken
+                for _ in range(taken):
+                    self._slots.release()
+        return hashes
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+
+class PooledPraetorian(flask_praetorian.Praetorian):
+    """ Praetorian whose password checks and hashing use a PasswordHasher """
+    hasher = None
+
+    def _verify_password(self, raw_password, hashed_password):
+        return self.hasher.verify(raw_password, hashed_password)
+
+    def encrypt_password(self, raw_password):
+        return self.hasher.hash(raw_password)
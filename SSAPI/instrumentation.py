@@ -0,0 +1,85 @@
+import json
+import logging
+import time
+from flask import current_app, g, has_app_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+class RequestTimings():
+    """ Counters collected for one request while INSTRUMENTATION is on """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_count = 0
+        self.sql_time = 0.0
+        self.serialize_time = 0.0
+
+
+def current_timings():
+    if has_app_context():
+        return g.get('_timings')
+    return None
+
+
+def record_serialization(elapsed):
+    timings = current_timings()
+    if timings is not None:
+        timings.serialize_time += elapsed
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('_query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    timings = current_timings()
+    starts = conn.info.get('_query_start')
+    if timings is not None and starts:
+        timings.sql_count += 1
+        timings.sql_time += time.perf_counter() - starts.pop()
+
+
+def start_request():
+    if current_app.config['INSTRUMENTATION']:
+        g._timings = RequestTimings()
+
+
+def finish_request(response):
+    timings = g.pop('_timings', None)
+    if timings is None:
+        return response
+
+    wall = time.perf_counter() - timings.start
+    json_bytes = None if response.is_streamed else response.content_length
+    response.headers.add('Server-Timing', ', '.join([
+        'db;dur=%.2f;desc="%d queries"' % (timings.sql_time * 1000,
+                                            timings.sql_count),
+        'serialize;dur=%.2f' % (timings.serialize_time * 1000),
+        'total;dur=%.2f' % (wall * 1000),
+    ]))
+    logger.info(json.dumps({
+        'method': request.method,
+        'route': request.url_rule.rule if request.url_rule else request.path,
+        'endpoint': request.endpoint,
+        'status': response.status_code,
+        'wall_ms': round(wall * 1000, 2),
+        'sql_count': timings.sql_count,
+        'sql_ms': round(timings.sql_time * 1000, 2),
+        'serialize_ms': round(timings.serialize_time * 1000, 2),
+        'json_bytes': json_bytes,
+    }, sort_keys=True))
+    return response
+
+
+def init_app(app):
+    """ Hooks per-request timing into app; active while INSTRUMENTATION """
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -1,23 +1,133 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, current_app
 from SSAPI.config import Config
 from SSAPI import app, api, db, guard
-from flask_restplus import Resource, Api
+from flask_restplus import Resource, Api, reqparse, inputs
 from flask_sqlalchemy import SQLAlchemy
+import datetime
 import flask_praetorian
+from SSAPI.database import reads_from_replica
+from SSAPI.invites import create_invites
+from SSAPI.json_backend import jsonify
 from SSAPI.models import *
+from SSAPI.pagination import add_page_arguments, keyset_page, set_next_cursor
 
 @api.route('/Invites')
 class InviteList(Resource):
+    @flask_praetorian.auth_required
+    @reads_from_replica
     def get(self):
-        """ Returns a list of Scrimmages """
-        pass
+        """ Returns the invites sent to me or for scrimmages I present """
+        current_user = flask_praetorian.current_user()
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('scrimmage_id', type=int)
+        parser.add_argument('pending', type=inputs.boolean)  # Unanswered?
+        add_page_arguments(parser)
+        args = parser.parse_args()
+
+        query = invite_serializer.query()
+        if not current_user.is_admin():
+            presenting = Scrimmage.member_ids(current_user.id,
+                                              as_presenter=True)
+            query = query.filter(
+                (ScrimmageInvite.advisor_id == current_user.id) |
+                (ScrimmageInvite.scrimmage_id.in_(presenting)))
+
+        if args["scrimmage_id"] is not None:
+            query = query.filter(
+                ScrimmageInvite.scrimmage_id == args["scrimmage_id"])
+
+        if args["pending"] is not None:
+            if args["pending"]:
+                query = query.filter(ScrimmageInvite.responded.is_(None))
+            else:
+                query = query.filter(ScrimmageInvite.responded.isnot(None))
+
+        result, next_cursor = keyset_page(query, ScrimmageInvite.id,
+                                          args["limit"], args["after"])
+        resp = jsonify(invite_serializer.dump_rows(result))
+        return set_next_cursor(resp, next_cursor)
+
+    @flask_praetorian.auth_required
     def post(self):
-        """ Create a new Scrimmage """
-        pass
+        """ Invites advisors to a Scrimmage """
+        parser = reqparse.RequestParser()
+        parser.add_argument('scrimmage_id', required=True, type=int)
+        parser.add_argument('advisors', required=True, type=list,
+                            location="json")
+        args = parser.parse_args()
+
+        scrimmage = Scrimmage.query.get(args["scrimmage_id"])
+        if scrimmage is None:
+            resp = jsonify({"message": "Unable to locate scrimmage"})
+            resp.status_code = 404
+            return resp
+
+        # If I am an admin, OR one of the presenters, I can invite
+        user = flask_praetorian.current_user()
+        if not (user in scrimmage.presenters or user.is_admin()):
+            resp = jsonify({"message": "Unauthorized to invite"})
+            resp.status_code = 401
+            return resp
+
+        if User.with_role(args["advisors"], "advisor") is None:
+            resp = jsonify({"message": "Unable to locate or invalid user for advisor"})
+            resp.status_code = 400
+            return resp
+
+        invites = create_invites(scrimmage.id, args["advisors"])
+        ret = [invite.as_dict() for invite in invites]
+        db.session.commit()
+
+        current_app.extensions['invite_scheduler'].wake()
+
+        resp = jsonify(ret)
+        resp.status_code = 201
+        return resp
 
 @api.route('/Invites/<int:id>')
 class Invites(Resource):
+    @reads_from_replica
     def get(self,id):
         """ Returns info about a Scrimmage """
         invite = ScrimmageInvite.query.filter_by(id=id).first()
         return jsonify(invite.as_dict())
+
+    @flask_praetorian.auth_required
+    def post(self, id):
+        """ Accepts or declines an invite, which stops its resends
+
+        Accepting takes a seat through Scrimmage.add_advisor, so parallel
+        acceptances cannot overfill the scrimmage; when it is full the
+        invite stays unanswered and 409 is returned.
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument('accepted', required=True, type=inputs.boolean)
+        args = parser.parse_args()
+
+        invite = ScrimmageInvite.query.get(id)
+        if invite is None:
+            resp = jsonify({"message": "Unable to locate invite"})
+            resp.status_code = 404
+            return resp
+
+        if invite.advisor_id != flask_praetorian.current_user().id:
+            resp = jsonify({"message": "Unauthorized to answer"})
+            resp.status_code = 401
+            return resp
+
+        if (args["accepted"] and
+                not Scrimmage.add_advisor(invite.scrimmage_id,
+                                          invite.advisor_id) and
+                not Scrimmage.is_advisor(invite.scrimmage_id,
+                                         invite.advisor_id)):
+            db.session.rollback()
+            resp = jsonify({"message": "Scrimmage is full"})
+            resp.status_code = 409
+            return resp
+
+        invite.accepted = args["accepted"]
+        invite.responded = datetime.datetime.utcnow()
+        db.session.commit()
+
+        return jsonify(invite.as_dict())
@@ -0,0 +1,261 @@
+import datetime
+import heapq
+import json
+import logging
+import threading
+from SSAPI import db
+from SSAPI.models import Scrimmage, ScrimmageInvite, User, version_bump
+from SSAPI.serializers import IN_CHUNK_SIZE
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryDelivery():
+    """ Keeps delivered invites in a list, for tests and development """
+
+    def __init__(self):
+        self.sent = []
+
+    def send(self, messages):
+        self.sent.extend(messages)
+
+
+class FileDelivery():
+    """ Appends each delivered invite to a file as a line of JSON """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send(self, messages):
+        lines = ''.join(json.dumps(m, sort_keys=True) + '\n'
+                        for m in messages)
+        with self._lock, open(self.path, 'a') as f:
+            f.write(lines)
+
+
+def load_delivery(name):
+    """ Returns the backend for INVITE_DELIVERY: 'memory' or 'file:<path>' """
+    if name == 'memory':
+        return MemoryDelivery()
+    if name.startswith('file:'):
+        return FileDelivery(name[len('file:'):])
+    raise ValueError("Unknown INVITE_DELIVERY %r" % name)
+
+
+def create_invites(scrimmage_id, advisor_ids):
+    """ Invites advisors not yet invited to scrimmage_id in one INSERT
+
+    The scrimmage's version is bumped, as its invites are part of its
+    ETag. Returns the new invites. The caller commits.
+    """
+    already = {advisor_id for (advisor_id,) in
+               db.session.query(ScrimmageInvite.advisor_id).filter(
+                   ScrimmageInvite.scrimmage_id == scrimmage_id,
+                   ScrimmageInvite.advisor_id.in_(advisor_ids))}
+    new_ids = [i for i in dict.fromkeys(advisor_ids) if i not in already]
+    if not new_ids:
+        return []
+
+    db.session.execute(ScrimmageInvite.__table__.insert(), [
+        {'scrimmage_id': scrimmage_id, 'advisor_id': advisor_id}
+        for advisor_id in new_ids])
+    Scrimmage.query.filter_by(id=scrimmage_id).update(
+        version_bump(Scrimmage), synchronize_session=False)
+    return ScrimmageInvite.query.filter(
+        ScrimmageInvite.scrimmage_id == scrimmage_id,
+        ScrimmageInvite.advisor_id.in_(new_ids)).order_by(
+        ScrimmageInvite.id).all()
+
+
+class ResendScheduler():
+    """ Sends invites and resends the unanswered ones every interval
+
+    Due invites sit in a min-heap of (next send time, invite id), so a tick
+    pops only what is due and loads just those rows by id. Answered or
+    deleted invites are dropped when they come up. The heap is filled from
+    every unanswered invite when the background thread starts, and each
+    tick adds the invites never sent yet, found through the last_sent
+    index, so invites created by any process are picked up. The thread
+    ticks at least every poll_interval seconds.
+    """
+
+    def __init__(self, delivery, interval, batch_size, poll_interval=10,
+                 clock=datetime.datetime.utcnow):
+        self.delivery = delivery
+        self.interval = datetime.timedelta(seconds=interval)
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self._heap = []
+        self._due = {}
+        self._wakeup = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self._woken = False
+
+    def __len__(self):
+        return len(self._due)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def wake(self):
+        """ Has the running thread look for new invites right away
+
+        Other processes' invites wait for the next poll instead. Does
+        nothing when this process does not run the thread.
+        """
+        if self.running:
+            with self._wakeup:
+                self._woken = True
+                self._wakeup.notify()
+
+    def queue(self, invite_ids, when):
+        """ Queues invites to be sent at when """
+        with self._wakeup:
+            for invite_id in invite_ids:
+                self._due[invite_id] = when
+                heapq.heappush(self._heap, (when, invite_id))
+
+    def load(self):
+        """ Queues every unanswered invite by when it was last sent """
+        rows = db.session.query(ScrimmageInvite.id,
+                                ScrimmageInvite.last_sent).filter(
+            ScrimmageInvite.responded.is_(None))
+        now = self.clock()
+        for invite_id, last_sent in rows:
+            when = last_sent + self.interval if last_sent else now
+            self.queue([invite_id], when)
+
+    def poll(self, now):
+        """ Queues the unanswered invites never sent, unless already queued """
+        rows = db.session.query(ScrimmageInvite.id).filter(
+            ScrimmageInvite.last_sent.is_(None),
+            ScrimmageInvite.responded.is_(None)).all()
+        with self._wakeup:
+            new_ids = [invite_id for (invite_id,) in rows
+                       if invite_id not in self._due]
+        self.queue(new_ids, now)
+        return len(new_ids)
+
+    def pop_due(self, now):
+        """ Removes and returns up to batch_size invite ids due by now """
+        ids = []
+        with self._wakeup:
+            while self._heap and len(ids) < self.batch_size:
+                when, invite_id = self._heap[0]
+                if when > now:
+                    break
+                heapq.heappop(self._heap)
+                # Skip entries superseded by a later queue() call
+                if self._due.get(invite_id) == when:
+                    del self._due[invite_id]
+                    ids.append(invite_id)
+        return ids
+
+    def tick(self, now=None):
+        """ Sends every new or due invite, batch by batch; returns how many """
+        now = now or self.clock()
+        self.poll(now)
+        sent = 0
+        while True:
+            ids = self.pop_due(now)
+            if not ids:
+                return sent
+            sent += self.send(ids, now)
+
+    def send(self, ids, now):
+        try:
+            return self.deliver(ids, now)
+        except Exception:
+            # Put the batch back so a failed delivery is retried
+            self.queue(ids, now + self.interval)
+            raise
+
+    def deliver(self, ids, now):
+        rows = []
+        for start in range(0, len(ids), IN_CHUNK_SIZE):
+            chunk = ids[start:start + IN_CHUNK_SIZE]
+            rows += db.session.query(
+                ScrimmageInvite.id, ScrimmageInvite.scrimmage_id,
+                ScrimmageInvite.advisor_id, User.username,
+                Scrimmage.subject, Scrimmage.schedule).join(
+                User, User.id == ScrimmageInvite.advisor_id).join(
+                Scrimmage,
+                Scrimmage.id == ScrimmageInvite.scrimmage_id).filter(
+                ScrimmageInvite.id.in_(chunk),
+                ScrimmageInvite.responded.is_(None)).all()
+        if not rows:
+            return 0
+
+        self.delivery.send([
+            {'invite_id': row.id, 'scrimmage_id': row.scrimmage_id,
+             'advisor_id': row.advisor_id, 'username': row.username,
+             'subject': row.subject, 'schedule': row.schedule,
+             'sent_at': now.isoformat()} for row in rows])
+
+        sent_ids = [row.id for row in rows]
+        ScrimmageInvite.query.filter(
+            ScrimmageInvite.id.in_(sent_ids)).update(
+            {'last_sent': now}, synchronize_session=False)
+        db.session.commit()
+        self.queue(sent_ids, now + self.interval)
+        return len(rows)
+
+    def next_due(self):
+        with self._wakeup:
+            return self._heap[0][0] if self._heap else None
+
+    def run(self, app):
+        with app.app_context():
+            self.load()
+            db.session.remove()
+        while not self._stopping:
+            with app.app_context():
+                try:
+                    self.tick()
+                except Exception:
+                    logger.exception("Sending invites failed")
+                    db.session.rollback()
+                finally:
+                    db.session.remove()
+            with self._wakeup:
+                due = self.next_due()
+                timeout = self.poll_interval
+                if due is not None:
+                    timeout = min(timeout,
+                                  (due - self.clock()).total_seconds())
+                if timeout > 0 and not (self._stopping or self._woken):
+                    self._wakeup.wait(timeout)
+                self._woken = False
+
+    def start(self, app):
+        """ Runs the scheduler on a daemon thread """
+        self._thread = threading.Thread(target=self.run, args=(app,),
+                                        name='invite-scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+
+
+def init_app(app):
+    """ Creates the scheduler; INVITE_SCHEDULER starts its thread once the
+    process serves its first request
+    """
+    scheduler = ResendScheduler(load_delivery(app.config['INVITE_DELIVERY']),
+                                app.config['INVITE_RESEND_SECONDS'],
+                                app.config['INVITE_BATCH_SIZE'],
+                                app.config['INVITE_POLL_SECONDS'])
+    app.extensions['invite_scheduler'] = scheduler
+    if app.config['INVITE_SCHEDULER']:
+        # Started with the first request rather than on import, so the
+        # password hashing workers, which import the app too, never run one
+        app.before_first_request(lambda: scheduler.start(app))
+    return scheduler
@@ -0,0 +1,79 @@
+import time
+from flask import current_app, json
+from SSAPI.instrumentation import record_serialization
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+class StdlibBackend():
+    """ Flask's own encoder, i.e. what jsonify always used """
+    name = 'json'
+
+    def dumps(self, obj, pretty=False):
+        if pretty:
+            return json.dumps(obj, indent=2, separators=(', ', ': '))
+        return json.dumps(obj, separators=(',', ':'))
+
+
+class OrjsonBackend():
+    """ orjson, deferring datetimes and other extras to Flask's encoder
+
+    Passing datetimes through to the Flask encoder keeps their format (HTTP
+    dates) identical to StdlibBackend.
+    """
+    name = 'orjson'
+
+    def dumps(self, obj, pretty=False):
+        option = orjson.OPT_PASSTHROUGH_DATETIME
+        if current_app.config['JSON_SORT_KEYS']:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        default = current_app.json_encoder().default
+        return orjson.dumps(obj, default=default, option=option).decode()
+
+
+def load_backend(name):
+    """ Returns the backend for JSON_BACKEND: 'auto', 'orjson' or 'json' """
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'json'
+    if name == 'orjson':
+        if orjson is None:
+            raise ImportError("JSON_BACKEND is 'orjson' but it is not installed")
+        return OrjsonBackend()
+    if name == 'json':
+        return StdlibBackend()
+    raise ValueError("Unknown JSON_BACKEND %r" % name)
+
+
+def dumps(obj, pretty=False):
+    start = time.perf_counter()
+    ret = current_app.extensions['json_backend'].dumps(obj, pretty)
+    record_serialization(time.perf_counter() - start)
+    return ret
+
+
+def jsonify(*args, **kwargs):
+    """ Drop-in replacement for flask.jsonify using the configured backend """
+    if args and kwargs:
+        raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+    elif len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return make_json_response(data)
+
+
+def make_json_response(data, status=None, headers=None):
+    pretty = (current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or
+              current_app.debug)
+    return current_app.response_class(
+        dumps(data, pretty) + "\n", status=status, headers=headers,
+        mimetype=current_app.config['JSONIFY_MIMETYPE'])
+
+
+def init_app(app):
+    app.extensions['json_backend'] = load_backend(app.config['JSON_BACKEND'])
@@ -0,0 +1,276 @@
+from bisect import bisect_left
+from flask import Response, g, request
+from sqlalchemy import event
+from sqlalchemy.pool import Pool
+import glob
+import json
+import os
+import threading
+import time
+
+# Upper bounds, in seconds, of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Fewest shards held before registering one also prunes finished threads
+PRUNE_MIN_SHARDS = 64
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def new_shard():
+    return {'requests': {}, 'latency': {}, 'checkouts': 0, 'checkins': 0}
+
+
+def merge_shard(into, shard):
+    for key, count in shard['requests'].items():
+        into['requests'][key] = into['requests'].get(key, 0) + count
+    for key, counts in shard['latency'].items():
+        total = into['latency'].setdefault(key, [0] * len(counts))
+        for i, count in enumerate(counts):
+            total[i] += count
+    into['checkouts'] += shard['checkouts']
+    into['checkins'] += shard['checkins']
+
+
+def copy_shard(shard):
+    # dict() and list() copies run without releasing the GIL, so they are
+    # safe against the owning thread updating the shard at the same time
+    return {'requests': dict(shard['requests']),
+            'latency': {key: list(counts) for key, counts in
+                        dict(shard['latency']).items()},
+            'checkouts': shard['checkouts'],
+            'checkins': shard['checkins']}
+
+
+class Registry():
+    """ Request and pool counters, sharded per thread so updates never lock
+
+    Each thread writes to its own shard; a scrape merges them. Shards of
+    finished threads are folded into a retired total, on every scrape and
+    whenever the shard list has doubled since it was last pruned, so
+    servers starting a thread per request hold at most about twice as
+    many shards as live threads.
+
+    With a directory set, every process also writes its totals to
+    metrics-<pid>.json there (at most once per flush_interval) and scrapes
+    add up all the files.
+    """
+
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.gauges = {}
+        self._local = threading.local()
+        self._shards = []
+        self._retired = new_shard()
+        self._prune_at = PRUNE_MIN_SHARDS
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._last_flush = 0
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = self._local.shard = new_shard()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+                if len(self._shards) >= self._prune_at:
+                    self._retire_finished()
+        return shard
+
+    def _retire_finished(self):
+        """ Folds shards of finished threads into _retired; holds _lock """
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                merge_shard(self._retired, shard)
+        self._shards = live
+        self._prune_at = max(PRUNE_MIN_SHARDS, 2 * len(live))
+        return live
+
+    def observe_request(self, route, method, status, elapsed):
+        shard = self._shard()
+        key = (route, method, status)
+        shard['requests'][key] = shard['requests'].get(key, 0) + 1
+        counts = shard['latency'].get((route, method))
+        if counts is None:
+            # One slot per bucket, then +Inf, then the sum of latencies
+            counts = shard['latency'][(route, method)] = \
+                [0] * (len(BUCKETS) + 2)
+        counts[bisect_left(BUCKETS, elapsed)] += 1
+        counts[-1] += elapsed
+
+    def count_checkout(self):
+        self._shard()['checkouts'] += 1
+
+    def count_checkin(self):
+        self._shard()['checkins'] += 1
+
+    def totals(self):
+        """ Counters of this process merged across threads """
+        with self._lock:
+            live = self._retire_finished()
+            total = copy_shard(self._retired)
+        for thread, shard in live:
+            merge_shard(total, copy_shard(shard))
+        total['gauges'] = {name: read() for name, read in self.gauges.items()}
+        return total
+
+    def path(self, pid):
+        return os.path.join(self.directory, 'metrics-%d.json' % pid)
+
+    def flush(self, force=False):
+        """ Write this process's totals for the other workers to read """
+        if not self.directory:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_flush < self.flush_interval:
+            return
+        if not self._flush_lock.acquire(blocking=force):
+            return
+        try:
+            self._last_flush = now
+            total = self.totals()
+            data = {'requests': [list(key) + [count] for key, count in
+                                 total['requests'].items()],
+                    'latency': [list(key) + [counts] for key, counts in
+                                total['latency'].items()],
+                    'checkouts': total['checkouts'],
+                    'checkins': total['checkins'],
+                    'gauges': total['gauges']}
+            path = self.path(os.getpid())
+            with open(path + '.tmp', 'w') as f:
+                json.dump(data, f)
+            os.replace(path + '.tmp', path)
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """ Totals for the whole server, across processes when shared """
+        if not self.directory:
+            return self.totals()
+
+        self.flush(force=True)
+        total = new_shard()
+        total['gauges'] = {}
+        pattern = os.path.join(self.directory, 'metrics-*.json')
+        for path in glob.glob(pattern):
+            try:
+                pid = int(os.path.basename(path)[8:-5])
+                with open(path) as f:
+                    data = json.load(f)
+            except (ValueError, OSError):
+                continue
+            # Counters of exited workers still count, their gauges and
+            # connections do not
+            alive = process_alive(pid)
+            checkins = data['checkins'] if alive else data['checkouts']
+            merge_shard(total, {
+                'requests': {tuple(row[:3]): row[3]
+                             for row in data['requests']},
+                'latency': {tuple(row[:2]): row[2]
+                            for row in data['latency']},
+                'checkouts': data['checkouts'],
+                'checkins': checkins})
+            if alive:
+                for name, value in data['gauges'].items():
+                    total['gauges'][name] = \
+                        total['gauges'].get(name, 0) + value
+        return total
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def labels(**values):
+    return '{%s}' % ','.join('%s="%s"' % (name, value.replace('"', '\\"'))
+                             for name, value in values.items())
+
+
+def render(total):
+    """ Formats collected totals in the Prometheus text format """
+    lines = ['# TYPE ssapi_requests_total counter']
+    errors = {}
+    for (route, method, status), count in sorted(total['requests'].items()):
+        lines.append('ssapi_requests_total%s %d' % (
+            labels(route=route, method=method, code=str(status)), count))
+        if status >= 500:
+            errors[(route, method)] = errors.get((route, method), 0) + count
+
+    lines.append('# TYPE ssapi_request_errors_total counter')
+    for (route, method), count in sorted(errors.items()):
+        lines.append('ssapi_request_errors_total%s %d' % (
+            labels(route=route, method=method), count))
+
+    lines.append('# TYPE ssapi_request_duration_seconds histogram')
+    for (route, method), counts in sorted(total['latency'].items()):
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), counts[:-1]):
+            cumulative += count
+            lines.append('ssapi_request_duration_seconds_bucket%s %d' % (
+                labels(route=route, method=method, le=str(bound)),
+                cumulative))
+        lines.append('ssapi_request_duration_seconds_sum%s %.6f' % (
+            labels(route=route, method=method), counts[-1]))
+        lines.append('ssapi_request_duration_seconds_count%s %d' % (
+            labels(route=route, method=method), cumulative))
+
+    lines.append('# TYPE ssapi_db_pool_checkouts_total counter')
+    lines.append('ssapi_db_pool_checkouts_total %d' % total['checkouts'])
+    lines.append('# TYPE ssapi_db_pool_checked_out gauge')
+    lines.append('ssapi_db_pool_checked_out %d' %
+                 (total['checkouts'] - total['checkins']))
+    for name, value in sorted(total['gauges'].items()):
+        lines.append('# TYPE ssapi_%s gauge' % name)
+        lines.append('ssapi_%s %d' % (name, value))
+    return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@event.listens_for(Pool, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    registry.count_checkout()
+
+
+@event.listens_for(Pool, 'checkin')
+def on_checkin(dbapi_connection, connection_record):
+    registry.count_checkin()
+
+
+def start_request():
+    g._metrics_start = time.perf_counter()
+
+
+def finish_request(response):
+    start = g.pop('_metrics_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else '<unmatched>'
+        registry.observe_request(route, request.method, response.status_code,
+                                 time.perf_counter() - start)
+        registry.flush()
+    return response
+
+
+def metrics():
+    return Response(render(registry.collect()), content_type=CONTENT_TYPE)
+
+
+def init_app(app, hasher):
+    """ Counts every request and serves the totals on /metrics """
+    registry.directory = app.config['METRICS_DIR']
+    registry.flush_interval = app.config['METRICS_FLUSH_SECONDS']
+    registry.gauges['password_hash_pending'] = lambda: hasher.pending
+    if registry.directory:
+        os.makedirs(registry.directory, exist_ok=True)
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.add_url_rule('/metrics', 'metrics', metrics)
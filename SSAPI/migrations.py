@@ -0,0 +1,95 @@
+from sqlalchemy import bindparam, inspect
+from sqlalchemy.schema import CreateColumn
+from SSAPI import db
+from SSAPI.models import (Scrimmage, ScrimmageInvite, User, UserRole,
+                          advisors, parse_roles, presenters)
+from SSAPI.schedule import schedule_columns
+from SSAPI import search
+
+
+def add_missing_columns(model):
+    """ Adds columns declared on model that its existing table lacks """
+    table = model.__table__
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name not in existing:
+            ddl = CreateColumn(column).compile(dialect=db.engine.dialect)
+            db.session.execute('ALTER TABLE "%s" ADD COLUMN %s'
+                               % (table.name, ddl))
+            added.append(column.name)
+    db.session.commit()
+    return added
+
+
+def add_version_columns():
+    """ Adds the version, updated_at and schedule time columns """
+    return add_missing_columns(User) + add_missing_columns(Scrimmage)
+
+
+def add_missing_indexes(table):
+    """ Creates indexes declared on table that the database lacks """
+    existing = {i['name'] for i in inspect(db.engine).get_indexes(table.name)}
+    added = []
+    for index in sorted(table.indexes, key=lambda i: i.name):
+        if index.name not in existing:
+            index.create(db.engine)
+            added.append(index.name)
+    return added
+
+
+def add_indexes():
+    """ Adds the association, foreign key, schedule and invite indexes """
+    added = []
+    for table in (presenters, advisors, ScrimmageInvite.__table__,
+                  UserRole.__table__, Scrimmage.__table__):
+        added += add_missing_indexes(table)
+    return added
+
+
+def populate_user_roles():
+    """ Builds the user_role table from the comma separated User.roles text """
+    UserRole.__table__.create(db.engine, checkfirst=True)
+
+    rows = []
+    for user_id, roles in db.session.query(User.id, User.roles):
+        for name in parse_roles(roles):
+            rows.append({'user_id': user_id, 'name': name})
+
+    db.session.query(UserRole).delete()
+    if rows:
+        db.session.execute(UserRole.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def populate_schedule_times():
+    """ Parses starts_at and ends_at from the schedule text where unset """
+    rows = db.session.query(Scrimmage.id, Scrimmage.schedule).filter(
+        Scrimmage.starts_at.is_(None), Scrimmage.schedule.isnot(None))
+    values = []
+    for scrimmage_id, schedule in rows:
+        columns = schedule_columns(schedule)
+        if columns['starts_at'] is not None:
+            columns['scrimmage_id'] = scrimmage_id
+            values.append(columns)
+
+    if values:
+        table = Scrimmage.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('scrimmage_id')),
+            values)
+    db.session.commit()
+    return len(values)
+
+
+def upgrade():
+    """ Brings a database made by an older setup_db.py up to date
+
+    Every step checks what is already there, so it is safe to run again.
+    """
+    return {'columns': add_version_columns(),
+            'roles': populate_user_roles(),
+            'indexes': add_indexes(),
+            'schedules': populate_schedule_times(),
+            'search': search.rebuild_index() if search.enabled() else 0}
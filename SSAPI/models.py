@@ -1,4 +1,40 @@
-from SSAPI import db
+import datetime
+from flask import g
+from SSAPI import app, db
+from SSAPI.cache import TTLCache
+from SSAPI.serializers import IN_CHUNK_SIZE, ModelSerializer
+from sqlalchemy.orm import make_transient_to_detached, validates
+from sqlalchemy.orm.attributes import set_committed_value
+
+
+identity_cache = TTLCache(app.config['IDENTITY_CACHE_SIZE'],
+                          app.config['IDENTITY_CACHE_TTL'])
+
+
+def parse_roles(roles):
+    """ Splits a comma separated role string into unique, ordered names """
+    names = []
+    for name in (roles or '').split(','):
+        name = name.strip()
+        if name and name not in names:
+            names.append(name)
+    return tuple(names)
+
+
+def version_bump(model):
+    """ UPDATE values that bump a row's version and modification time """
+    return {'version': model.version + 1,
+            'updated_at': datetime.datetime.utcnow()}
+
+
+class UserRole(db.Model):
+    # Normalized copy of User.roles, one row per (user, role), so role
+    # filters are an index lookup instead of a LIKE over the user table
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'),
+                        primary_key=True)
+    name = db.Column(db.Text, primary_key=True)
+
+    __table_args__ = (db.Index('ix_user_role_name_user', 'name', 'user_id'),)
 
 
 class User(db.Model):
@@ -9,14 +45,61 @@ class User(db.Model):
     lastname = db.Column(db.Text)
     roles = db.Column(db.Text)
     is_active = db.Column(db.Boolean, default=True, server_default='true')
+    # Bumped on every change; drives the ETag and Last-Modified headers
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
     invitations = db.relationship("ScrimmageInvite", backref='advisor')
+    role_entries = db.relationship("UserRole", cascade="all, delete-orphan")
+
+    # Columns Users.post may change on your own record; only admins may
+    # change the admin ones, so nobody can grant themselves a role
+    updatable_columns = frozenset(('username', 'password', 'firstname',
+                                   'lastname'))
+    admin_updatable_columns = updatable_columns | {'roles', 'is_active'}
+
+    @validates('roles')
+    def validate_roles(self, key, roles):
+        names = parse_roles(roles)
+        self.role_entries = [UserRole(name=name) for name in names]
+        return ','.join(names)
+
+    def _parsed_roles(self):
+        # Parsed once per distinct roles value and kept on the instance
+        roles = self.roles
+        cached = self.__dict__.get('_parsed_roles_cache')
+        if cached is None or cached[0] is not roles:
+            names = parse_roles(roles)
+            cached = (roles, list(names), frozenset(names))
+            self.__dict__['_parsed_roles_cache'] = cached
+        return cached
 
     @property
     def rolenames(self):
-        try:
-            return self.roles.split(',')
-        except Exception:
-            return []
+        return list(self._parsed_roles()[1])
+
+    @property
+    def role_set(self):
+        return self._parsed_roles()[2]
+
+    def has_role(self, name):
+        return name in self._parsed_roles()[2]
+
+    def diff(self, values):
+        """ The subset of values that differs from the current columns """
+        return {key: value for key, value in values.items()
+                if getattr(self, key) != value}
+
+    def apply_changes(self, changes):
+        """ Applies a validated diff, flushed as a single UPDATE """
+        # Setting roles loads role_entries, which must not flush half of
+        # the diff early
+        with db.session.no_autoflush:
+            for key, value in changes.items():
+                setattr(self, key, value)
+        if changes:
+            self.version = User.version + 1
 
     @classmethod
     def lookup(cls, username):
@@ -24,7 +107,64 @@ class User(db.Model):
 
     @classmethod
     def identify(cls, id):
-        return cls.query.get(id)
+        # Requests resolve the token user once, whatever the number of
+        # current_user() calls, and may reuse a recent detached copy
+        # from the process cache instead of querying at all
+        request_cache = g.setdefault('_identities', {})
+        if id in request_cache:
+            return request_cache[id]
+
+        cached = identity_cache.get(id)
+        if cached is not None:
+            user = db.session.merge(cached, load=False)
+        else:
+            user = cls.query.get(id)
+            if user is not None and identity_cache.ttl > 0:
+                identity_cache.set(id, user.detached_copy())
+
+        request_cache[id] = user
+        return user
+
+    def detached_copy(self):
+        """ Column-only copy that is safe to share outside this session """
+        mapper = self.__mapper__
+        copy = mapper.class_manager.new_instance()
+        for attr in mapper.column_attrs:
+            set_committed_value(copy, attr.key, getattr(self, attr.key))
+        make_transient_to_detached(copy)
+        return copy
+
+    @classmethod
+    def forget(cls, id):
+        """ Drops any cached identity for the user after it changes """
+        g.get('_identities', {}).pop(id, None)
+        identity_cache.pop(id)
+
+    @classmethod
+    def ids_by_username(cls, usernames):
+        """ Maps each of the usernames that exists to its user id """
+        usernames = list(usernames)
+        found = {}
+        for start in range(0, len(usernames), IN_CHUNK_SIZE):
+            chunk = usernames[start:start + IN_CHUNK_SIZE]
+            found.update(db.session.query(cls.username, cls.id).filter(
+                cls.username.in_(chunk)))
+        return found
+
+    @classmethod
+    def with_role(cls, ids, role):
+        """ Resolves ids to users holding role, or None if any id is invalid
+
+        All ids are fetched with a single IN query and checked in memory.
+        """
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return []
+        found = {u.id: u for u in cls.query.filter(cls.id.in_(ids))}
+        users = [found.get(i) for i in ids]
+        if not all(u is not None and u.has_role(role) for u in users):
+            return None
+        return users
 
     @property
     def identity(self):
@@ -34,26 +174,26 @@ class User(db.Model):
         return self.is_active
 
     def is_admin(self):
-        return "admin" in self.roles
+        return self.has_role("admin")
 
     def as_dict(self):
-        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name not in "password"}
+        return user_serializer.dump(self)
 
 
 class ScrimmageInvite(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     accepted = db.Column(db.Boolean)
-    last_sent = db.Column(db.DateTime)
+    # Never sent invites (last_sent IS NULL) are polled by the scheduler
+    last_sent = db.Column(db.DateTime, index=True)
     responded = db.Column(db.DateTime)
-    advisor_id = db.Column(db.Integer, db.ForeignKey("user.id"))
-    scrimmage_id = db.Column(db.Integer, db.ForeignKey("scrimmage.id"))
+    advisor_id = db.Column(db.Integer, db.ForeignKey("user.id"), index=True)
+    scrimmage_id = db.Column(db.Integer, db.ForeignKey("scrimmage.id"),
+                             index=True)
 
     def as_dict(self):
-        return_dict = {c.name: getattr(self, c.name) for c in self.__table__.columns}
         # Note we don't need to follow the relationships here, as the foreign
         # keys will provide with the ID of the related object
-
-        return return_dict
+        return invite_serializer.dump(self)
 
 # Many-to-Many reference tables for Scrimmage class
 presenters = db.Table('presenters',
@@ -62,14 +202,20 @@ presenters = db.Table('presenters',
                                 primary_key=True),
                       db.Column('scrimmage_id', db.Integer,
                                 db.ForeignKey('scrimmage.id'),
-                                primary_key=True)
+                                primary_key=True),
+                      # The primary key covers user -> scrimmage lookups,
+                      # this one scrimmage -> user
+                      db.Index('ix_presenters_scrimmage_user',
+                               'scrimmage_id', 'user_id')
                       )
 
 advisors = db.Table('advisors',
                     db.Column('user_id', db.Integer,
                               db.ForeignKey('user.id'), primary_key=True),
                     db.Column('scrimmage_id', db.Integer,
-                              db.ForeignKey('scrimmage.id'), primary_key=True)
+                              db.ForeignKey('scrimmage.id'), primary_key=True),
+                    db.Index('ix_advisors_scrimmage_user',
+                             'scrimmage_id', 'user_id')
                     )
 
 
@@ -77,9 +223,18 @@ class Scrimmage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     subject = db.Column(db.Text)
     schedule = db.Column(db.Text)
+    # Parsed from schedule by SSAPI.schedule.schedule_columns
+    starts_at = db.Column(db.DateTime, index=True)
+    ends_at = db.Column(db.DateTime, index=True)
     scrimmage_type = db.Column(db.Text)
     scrimmage_complete = db.Column(db.Boolean)
     max_advisors = db.Column(db.Integer)
+    # Bumped on every change, including membership; drives the ETag and
+    # Last-Modified headers
+    version = db.Column(db.Integer, nullable=False, default=1,
+                        server_default='1')
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
     presenters = db.relationship('User', secondary=presenters,
                                  backref=db.backref('scrimmages_presenter',
                                                     lazy=True))
@@ -88,17 +243,84 @@ class Scrimmage(db.Model):
                                                   lazy=True))
     invites = db.relationship('ScrimmageInvite', backref="scrimmage")
 
+    @classmethod
+    def with_members(cls):
+        """ Query that batch loads presenters, advisors and invites """
+        # One SELECT ... IN per relationship, regardless of the row count,
+        # rather than three lazy loads for every scrimmage in as_dict()
+        return cls.query.options(db.selectinload(cls.presenters),
+                                 db.selectinload(cls.advisors),
+                                 db.selectinload(cls.invites))
+
+    @staticmethod
+    def add_advisor(scrimmage_id, user_id):
+        """ Adds user_id as an advisor unless the scrimmage is full
+
+        The seat count is checked by the INSERT itself, so concurrent joins
+        cannot overfill max_advisors. Returns False, inserting nothing, when
+        the scrimmage is full or the user already advises it. The caller
+        commits.
+        """
+        # Serializes joins on the scrimmage row where the database has row
+        # locks; SQLite holds its write lock for the INSERT instead
+        db.session.query(Scrimmage.id).filter(
+            Scrimmage.id == scrimmage_id).with_for_update().first()
+
+        taken = db.select([db.func.count()]).where(
+            advisors.c.scrimmage_id == scrimmage_id).as_scalar()
+        limit = db.select([Scrimmage.max_advisors]).where(
+            Scrimmage.id == scrimmage_id).as_scalar()
+        already = db.exists().where(db.and_(
+            advisors.c.scrimmage_id == scrimmage_id,
+            advisors.c.user_id == user_id))
+        seat = db.select([db.literal(user_id),
+                          db.literal(scrimmage_id)]).where(
+            db.and_(taken < limit, ~already))
+        inserted = db.session.execute(advisors.insert().from_select(
+            ['user_id', 'scrimmage_id'], seat)).rowcount
+        if inserted != 1:
+            return False
+
+        Scrimmage.query.filter_by(id=scrimmage_id).update(
+            version_bump(Scrimmage), synchronize_session=False)
+        return True
+
+    @staticmethod
+    def is_advisor(scrimmage_id, user_id):
+        return db.session.query(db.exists().where(db.and_(
+            advisors.c.scrimmage_id == scrimmage_id,
+            advisors.c.user_id == user_id))).scalar()
+
+    @staticmethod
+    def member_ids(user_id, as_advisor=False, as_presenter=False):
+        """ Selects the ids of scrimmages user_id advises or presents
+
+        Reads the association tables through their (user_id, scrimmage_id)
+        primary keys, so the cost follows the user's own memberships rather
+        than the size of the scrimmage table. as_advisor and as_presenter
+        narrow it to scrimmages where the user holds each of those roles.
+        """
+        advising = db.select([advisors.c.scrimmage_id]).where(
+            advisors.c.user_id == user_id)
+        presenting = db.select([presenters.c.scrimmage_id]).where(
+            presenters.c.user_id == user_id)
+        if as_advisor and as_presenter:
+            return db.intersect(advising, presenting)
+        if as_advisor:
+            return advising
+        if as_presenter:
+            return presenting
+        return db.union(advising, presenting)
+
     def as_dict(self):
-        return_dict = {c.name: getattr(self, c.name) for c in self.__table__.columns}
-        # Follow the M2M relationships to return presenter and advisor IDs
-        return_dict["presenters"] = []
-        return_dict["advisors"] = []
-        return_dict["invites"] = []
-        for p in self.presenters:
-            return_dict["presenters"].append(p.id)
-        for a in self.advisors:
-            return_dict["advisors"].append(a.id)
-        for i in self.invites:
-            return_dict["invites"].append(i.id)
-
-        return return_dict
\ No newline at end of file
+        # Follows the M2M relationships to return presenter and advisor IDs
+        return scrimmage_serializer.dump(self)
+
+
+user_serializer = ModelSerializer(User, exclude=('password',))
+invite_serializer = ModelSerializer(ScrimmageInvite)
+scrimmage_serializer = ModelSerializer(Scrimmage, collections={
+    'presenters': (presenters.c.scrimmage_id, presenters.c.user_id),
+    'advisors': (advisors.c.scrimmage_id, advisors.c.user_id),
+    'invites': (ScrimmageInvite.scrimmage_id, ScrimmageInvite.id),
+})
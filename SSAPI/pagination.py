@@ -0,0 +1,45 @@
+from flask import current_app
+from flask_restplus import inputs
+
+
+def add_page_arguments(parser):
+    """ Adds the keyset pagination arguments to a request parser """
+    parser.add_argument('limit', type=inputs.positive)  # page size
+    parser.add_argument('after', type=int)  # id of the last row already seen
+    return parser
+
+
+def keyset_query(query, key, after=None):
+    """ Orders query by key and skips everything up to and including after
+
+    Pages are selected with ``key > after`` so each page is a range scan on
+    the key's index rather than an OFFSET that gets slower every page.
+    """
+    query = query.order_by(key)
+    if after is not None:
+        query = query.filter(key > after)
+    return query
+
+
+def keyset_page(query, key, limit=None, after=None):
+    """ Returns (rows, next_cursor) for one page of query ordered by key """
+    query = keyset_query(query, key, after)
+
+    if limit is None:
+        return query.all(), None
+
+    limit = min(limit, current_app.config['MAX_PAGE_SIZE'])
+    # Fetch one extra row to learn whether another page exists
+    rows = query.limit(limit + 1).all()
+    if len(rows) <= limit:
+        return rows, None
+
+    rows = rows[:limit]
+    return rows, getattr(rows[-1], key.key)
+
+
+def set_next_cursor(resp, next_cursor):
+    """ Advertises the cursor for the next page, if there is one """
+    if next_cursor is not None:
+        resp.headers['X-Next-Cursor'] = str(next_cursor)
+    return resp
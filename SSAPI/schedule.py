@@ -0,0 +1,141 @@
+from collections import defaultdict
+import datetime
+import heapq
+from SSAPI import app, db
+from SSAPI.models import Scrimmage, advisors, presenters
+from SSAPI.serializers import IN_CHUNK_SIZE
+
+
+def to_utc(value):
+    """ Naive UTC datetime for an aware or (assumed UTC) naive one """
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def parse_time(text):
+    text = text.strip()
+    if text.endswith('Z') or text.endswith('z'):
+        text = text[:-1] + '+00:00'
+    return to_utc(datetime.datetime.fromisoformat(text))
+
+
+def parse_schedule(text):
+    """ (starts_at, ends_at) for an ISO 8601 time or start/end interval
+
+    A single time lasts SCRIMMAGE_DEFAULT_MINUTES. Text that is not ISO
+    8601 gives (None, None), leaving the scrimmage out of range queries
+    and conflict checks.
+    """
+    if not text:
+        return None, None
+    try:
+        if '/' in text:
+            start, end = (parse_time(part) for part in text.split('/', 1))
+        else:
+            start = parse_time(text)
+            end = start + datetime.timedelta(
+                minutes=app.config['SCRIMMAGE_DEFAULT_MINUTES'])
+    except ValueError:
+        return None, None
+    if end < start:
+        return None, None
+    return start, end
+
+
+def schedule_columns(text):
+    """ UPDATE values that keep starts_at and ends_at in step with text """
+    starts_at, ends_at = parse_schedule(text)
+    return {'starts_at': starts_at, 'ends_at': ends_at}
+
+
+def find_overlaps(intervals):
+    """ Pairs of intervals that overlap for the same key
+
+    intervals holds (key, start, end, item) tuples. They are sorted by key
+    and start and swept once, keeping a heap of the intervals still open,
+    so the cost is O(n log n) plus the number of overlaps found. Intervals
+    that merely touch (one ends as the next starts) do not overlap.
+    """
+    overlaps = []
+    active = []
+    current_key = object()
+    for key, start, end, item in sorted(intervals, key=lambda i: i[:2]):
+        if key != current_key:
+            current_key, active = key, []
+        while active and active[0][0] <= start:
+            heapq.heappop(active)
+        for _, other in active:
+            overlaps.append((key, other, item))
+        heapq.heappush(active, (end, item))
+    return overlaps
+
+
+def member_intervals(user_ids=None, starts_before=None, ends_after=None,
+                     exclude_id=None):
+    """ (user id, start, end, scrimmage id) for every membership
+
+    Presenters and advisors come from one UNION query per IN chunk of
+    user_ids (or one for everyone), limited to scrimmages overlapping the
+    window when one is given.
+    """
+    def query(ids):
+        selects = []
+        for table in (presenters, advisors):
+            select = db.select([table.c.user_id, Scrimmage.starts_at,
+                                Scrimmage.ends_at, Scrimmage.id]).where(
+                table.c.scrimmage_id == Scrimmage.id).where(
+                Scrimmage.starts_at.isnot(None))
+            if ids is not None:
+                select = select.where(table.c.user_id.in_(ids))
+            if starts_before is not None:
+                select = select.where(Scrimmage.starts_at < starts_before)
+            if ends_after is not None:
+                select = select.where(Scrimmage.ends_at > ends_after)
+            if exclude_id is not None:
+                select = select.where(Scrimmage.id != exclude_id)
+            selects.append(select)
+        return [tuple(row) for row in db.session.execute(db.union(*selects))]
+
+    if user_ids is None:
+        return query(None)
+    user_ids = list(dict.fromkeys(user_ids))
+    rows = []
+    for start in range(0, len(user_ids), IN_CHUNK_SIZE):
+        rows += query(user_ids[start:start + IN_CHUNK_SIZE])
+    return rows
+
+
+def member_conflicts(scrimmage_id, starts_at, ends_at, user_ids):
+    """ Other scrimmages that overlap this one for any of user_ids
+
+    Returns [{'user_id', 'scrimmage_id'}] sorted by user and scrimmage.
+    """
+    if starts_at is None or not user_ids:
+        return []
+    intervals = member_intervals(user_ids, starts_before=ends_at,
+                                 ends_after=starts_at,
+                                 exclude_id=scrimmage_id)
+    intervals += [(user_id, starts_at, ends_at, scrimmage_id)
+                  for user_id in set(user_ids)]
+    conflicts = set()
+    for user_id, first, second in find_overlaps(intervals):
+        if first == scrimmage_id or second == scrimmage_id:
+            other = second if first == scrimmage_id else first
+            conflicts.add((user_id, other))
+    return [{'user_id': user_id, 'scrimmage_id': other}
+            for user_id, other in sorted(conflicts)]
+
+
+def all_conflicts(starts_before=None, ends_after=None):
+    """ Every pair of overlapping scrimmages sharing a presenter or advisor
+
+    Returns {user id: [(scrimmage id, scrimmage id), ...]}.
+    """
+    intervals = member_intervals(starts_before=starts_before,
+                                 ends_after=ends_after)
+    conflicts = defaultdict(set)
+    for user_id, first, second in find_overlaps(intervals):
+        if first != second:
+            conflicts[user_id].add(tuple(sorted((first, second))))
+    return {user_id: sorted(pairs) for user_id, pairs in conflicts.items()}
@@ -1,58 +1,84 @@
-from flask import Flask, request, jsonify
+import datetime
+from flask import Flask, request
 from SSAPI import app, api, db, guard
 from flask_restplus import Resource, reqparse, inputs
 import flask_praetorian
+from SSAPI import assignment
+from SSAPI.database import reads_from_replica
+from SSAPI.json_backend import jsonify
 from SSAPI.models import *
+from SSAPI.conditional import conditional_get
+from SSAPI.pagination import (add_page_arguments, keyset_page, keyset_query,
+                              set_next_cursor)
+from SSAPI import search
+from SSAPI.schedule import (all_conflicts, member_conflicts, schedule_columns,
+                            to_utc)
+from SSAPI.streaming import (add_stream_arguments, stream_requested,
+                             stream_response)
+
+
+def visible_to(query, user_id, show_all=False, role=None):
+    """ Narrows a Scrimmage query to those user_id may list
+
+    With show_all (admins only) every scrimmage is visible; otherwise the
+    query starts from the user's memberships and joins the scrimmages to
+    them. role ('advisor', 'presenter' or both) narrows it further.
+    """
+    role = role or ""
+    if show_all and not role:
+        return query
+    members = Scrimmage.member_ids(user_id, "advisor" in role,
+                                   "presenter" in role).alias('members')
+    return query.join(members, members.c.scrimmage_id == Scrimmage.id)
 
 
 @api.route('/Scrimmages')
 class ScrimmageList(Resource):
     @flask_praetorian.auth_required
+    @reads_from_replica
     def get(self):
         """ Returns a list of Scrimmages """
-        current_id = flask_praetorian.current_user().id
-        current_user_roles = flask_praetorian.current_user().roles
+        current_user = flask_praetorian.current_user()
+        current_id = current_user.id
+        current_user_is_admin = current_user.is_admin()
 
         # Filtering/sorting
         parser = reqparse.RequestParser()
         parser.add_argument('role', type=str)  # role (advisor or presenter)
         parser.add_argument('all', type=inputs.boolean)  # all admin only
         parser.add_argument('scrimmage_complete', type=inputs.boolean)  # Completed?
+        add_time_range_arguments(parser)
+        add_page_arguments(parser)
+        add_stream_arguments(parser)
         args = parser.parse_args()
 
-        query = None
-        if args["all"]:
-            if "admin" in current_user_roles:
-                query = Scrimmage.query
-            else:
-                query = Scrimmage.query.filter(
-                    (Scrimmage.advisors.any(User.id == current_id)) |
-                    (Scrimmage.presenters.any(User.id == current_id)))
-        else:
-            query = Scrimmage.query.filter(
-                (Scrimmage.advisors.any(User.id == current_id)) |
-                (Scrimmage.presenters.any(User.id == current_id)))
-
-        if args["role"]:
-            if "advisor" in args["role"]:
-                query = query.filter(
-                    Scrimmage.advisors.any(User.id == current_id))
-
-            if "presenter" in args["role"]:
-                query = query.filter(Scrimmage.presenters.any(
-                    User.id == current_id))
+        query = visible_to(scrimmage_serializer.query(), current_id,
+                           args["all"] and current_user_is_admin,
+                           args["role"])
 
         if args["scrimmage_complete"] is not None:
             query = query.filter(
                 Scrimmage.scrimmage_complete == args["scrimmage_complete"])
 
-        ret = []
-        result = query.all()
-        for i in result:
-            ret.append(i.as_dict())
+        # Start times in [from, to), a range scan on ix_scrimmage_starts_at
+        if args["from"] is not None:
+            query = query.filter(Scrimmage.starts_at >= to_utc(args["from"]))
+        if args["to"] is not None:
+            query = query.filter(Scrimmage.starts_at < to_utc(args["to"]))
+
+        mimetype = stream_requested(args)
+        if mimetype:
+            query = keyset_query(query, Scrimmage.id, args["after"])
+            return stream_response(query, scrimmage_serializer.dump_rows,
+                                   mimetype)
+
+        # Serialize straight from row tuples, batch loading member ids
+        result, next_cursor = keyset_page(query, Scrimmage.id,
+                                          args["limit"], args["after"])
+        ret = scrimmage_serializer.dump_rows(result)
 
         resp = jsonify(ret)
-        return resp
+        return set_next_cursor(resp, next_cursor)
 
     @flask_praetorian.auth_required
     def post(self):
@@ -72,37 +98,163 @@ class ScrimmageList(Resource):
                                   schedule=args["schedule"],
                                   scrimmage_complete=False,
                                   scrimmage_type=args["scrimmage_type"],
-                                  max_advisors=args["max_advisors"])
-
-        for i in args["presenters"]:
-            scrimmage_user = User.query.filter_by(id=i).first()
-            if "presenter" in scrimmage_user.roles:
-                new_scrimmage.presenters.append(scrimmage_user)
-            else:
-                resp = jsonify({"message": "Unable to locate or invalid user for presenter"})
-                resp.status_code = 400
-                return resp
+                                  max_advisors=args["max_advisors"],
+                                  **schedule_columns(args["schedule"]))
+
+        presenters = User.with_role(args["presenters"], "presenter")
+        if presenters is None:
+            resp = jsonify({"message": "Unable to locate or invalid user for presenter"})
+            resp.status_code = 400
+            return resp
+        new_scrimmage.presenters = presenters
 
         db.session.add(new_scrimmage)
         db.session.commit()
 
-        resp = jsonify(new_scrimmage.as_dict())
+        resp = jsonify(with_conflicts(new_scrimmage, args["presenters"]))
         resp.status_code = 200
         return resp
 
 
+def add_time_range_arguments(parser):
+    parser.add_argument('from', type=inputs.datetime_from_iso8601)
+    parser.add_argument('to', type=inputs.datetime_from_iso8601)
+    return parser
+
+
+def with_conflicts(scrimmage, user_ids):
+    """ as_dict() plus any double bookings of user_ids under 'conflicts' """
+    ret = scrimmage.as_dict()
+    conflicts = member_conflicts(scrimmage.id, scrimmage.starts_at,
+                                 scrimmage.ends_at, user_ids)
+    if conflicts:
+        ret["conflicts"] = conflicts
+    return ret
+
+
+def scrimmage_not_found():
+    resp = jsonify({"message": "Unable to locate scrimmage"})
+    resp.status_code = 404
+    return resp
+
+
+def version_conflict(version):
+    resp = jsonify({"message": "Scrimmage was changed by another request",
+                    "version": version})
+    resp.status_code = 409
+    return resp
+
+
+@api.route('/Scrimmages/Search')
+class ScrimmageSearch(Resource):
+    @flask_praetorian.auth_required
+    @reads_from_replica
+    def get(self):
+        """ Full text search of Scrimmage subjects and types, best first """
+        current_user = flask_praetorian.current_user()
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('q', required=True, type=str)  # words to find
+        parser.add_argument('prefix', type=inputs.boolean)  # typeahead
+        parser.add_argument('role', type=str)
+        parser.add_argument('all', type=inputs.boolean)  # all admin only
+        parser.add_argument('limit', type=inputs.positive)
+        args = parser.parse_args()
+
+        if not search.enabled():
+            resp = jsonify({"message": "Search needs an SQLite database"})
+            resp.status_code = 501
+            return resp
+
+        expression = search.match_expression(args["q"], args["prefix"])
+        if expression is None:
+            resp = jsonify({"message": "Nothing to search for"})
+            resp.status_code = 400
+            return resp
+
+        query = visible_to(scrimmage_serializer.query(), current_user.id,
+                           args["all"] and current_user.is_admin(),
+                           args["role"])
+        limit = min(args["limit"] or app.config['SEARCH_PAGE_SIZE'],
+                    app.config['MAX_PAGE_SIZE'])
+        rows = search.search(query, expression).limit(limit).all()
+        return jsonify(scrimmage_serializer.dump_rows(rows))
+
+
+@api.route('/Scrimmages/Assign')
+class ScrimmageAssign(Resource):
+    @flask_praetorian.auth_required
+    def post(self):
+        """ Assigns advisors to the open seats of incomplete Scrimmages """
+        if not flask_praetorian.current_user().is_admin():
+            return 'UNAUTHORIZED', 401
+
+        parser = reqparse.RequestParser()
+        parser.add_argument('dry_run', type=inputs.boolean)  # Only report
+        parser.add_argument('fill', type=inputs.boolean)  # Beyond invites
+        parser.add_argument('per_advisor', type=inputs.positive)
+        args = parser.parse_args()
+
+        per_advisor = (args["per_advisor"] or
+                       app.config['ASSIGNMENT_MAX_PER_ADVISOR'])
+        ret = assignment.solve(per_advisor, bool(args["fill"]))
+        ret["dry_run"] = bool(args["dry_run"])
+        ret["skipped"] = []
+        if not args["dry_run"]:
+            # Seats taken since solve() are reported, not overfilled
+            ret["skipped"] = assignment.apply(ret["assignments"])
+            ret["assignments"] = [a for a in ret["assignments"]
+                                  if a not in ret["skipped"]]
+            db.session.commit()
+
+        return jsonify(ret)
+
+
+@api.route('/Scrimmages/Conflicts')
+class ScrimmageConflicts(Resource):
+    @flask_praetorian.auth_required
+    @reads_from_replica
+    def get(self):
+        """ Lists presenters and advisors booked on overlapping Scrimmages """
+        if not flask_praetorian.current_user().is_admin():
+            return 'UNAUTHORIZED', 401
+
+        parser = reqparse.RequestParser()
+        add_time_range_arguments(parser)
+        args = parser.parse_args()
+
+        conflicts = all_conflicts(to_utc(args["to"]), to_utc(args["from"]))
+        return jsonify([{"user_id": user_id, "scrimmages": list(pair)}
+                        for user_id, pairs in sorted(conflicts.items())
+                        for pair in pairs])
+
+
 @api.route('/Scrimmages/<int:id>')
 class Scrimmages(Resource):
     @flask_praetorian.auth_required
+    @reads_from_replica
     def get(self, id):
         """ Returns info about a Scrimmage """
-        scrimmage = Scrimmage.query.filter_by(id=id).first()
-        return jsonify(scrimmage.as_dict())
+        def load():
+            scrimmage = Scrimmage.with_members().filter_by(id=id).first()
+            return jsonify(scrimmage.as_dict())
+
+        return conditional_get(Scrimmage, id, load)
 
     @flask_praetorian.auth_required
     def post(self, id):
         """ Updates a scrimmage """
         scrimmage = Scrimmage.query.filter_by(id=id).first()
+        if scrimmage is None:
+            return scrimmage_not_found()
+
+        # If I am an admin, OR one of the presenters, I can modify
+        user = flask_praetorian.current_user()
+        if not (user in scrimmage.presenters or user.is_admin()):
+            resp = jsonify({"message": "Unauthorized to update"})
+            resp.status_code = 401
+            return resp
+
         parser = reqparse.RequestParser()
         parser.add_argument('subject', type=str)
         parser.add_argument('schedule', type=str)
@@ -111,53 +263,74 @@ class Scrimmages(Resource):
         parser.add_argument('advisors', type=list, location="json")
         parser.add_argument('max_advisors', type=int)
         parser.add_argument('scrimmage_complete', type=inputs.boolean)
+        parser.add_argument('version', type=int)  # Version the client read
         args = parser.parse_args()
 
-        # If I am an admin, OR one of the presenters, I can modify
-        user_id = flask_praetorian.current_user().id
-        user = User.query.filter_by(id=user_id).first()
-
-        if (user in scrimmage.presenters or
-                'admin' in flask_praetorian.current_user().roles):
-            update_dict = {}
-            for param in args.keys():
-                if args[param]:
-                    new_presenters = []
-                    new_advisors = []
-                    if "presenters" in param:
-                        for i in args[param]:
-                            new_presenter = User.query.filter_by(id=i).first()
-                            if new_presenter and 'presenter' in new_presenter.roles:
-                                new_presenters.append(new_presenter)
-                            else:
-                                resp = jsonify({"message": "Unable to locate or invalid user for presenter"})
-                                resp.status_code = 400
-                                return resp
-                        scrimmage.presenters = new_presenters
-                    elif "advisors" in param:
-                        for i in args[param]:
-                            new_advisor = User.query.filter_by(id=i).first()
-                            if new_advisor and 'advisor' in new_advisor.roles:
-                                new_advisors.append(new_advisor)
-                            else:
-                                resp = jsonify({"message": "Unable to locate or invalid user for advisor"})
-                                resp.status_code = 400
-                                return resp
-                        scrimmage.advisors = new_advisors
-                    else:
-                        update_dict[param] = args[param]
-
-            if update_dict:
-                Scrimmage.query.filter_by(id=id).update(update_dict)
+        # Only applied if the row is still at the version the changes were
+        # based on: the client's, or else the one loaded above
+        expected_version = args.pop("version")
+        if expected_version is None:
+            expected_version = scrimmage.version
+        elif expected_version != scrimmage.version:
+            return version_conflict(scrimmage.version)
 
-            db.session.commit()
+        update_dict = {}
+        for param in args.keys():
+            if args[param]:
+                if "presenters" in param:
+                    new_presenters = User.with_role(args[param], 'presenter')
+                    if new_presenters is None:
+                        resp = jsonify({"message": "Unable to locate or invalid user for presenter"})
+                        resp.status_code = 400
+                        return resp
+                    scrimmage.presenters = new_presenters
+                elif "advisors" in param:
+                    new_advisors = User.with_role(args[param], 'advisor')
+                    if new_advisors is None:
+                        resp = jsonify({"message": "Unable to locate or invalid user for advisor"})
+                        resp.status_code = 400
+                        return resp
+                    scrimmage.advisors = new_advisors
+                else:
+                    update_dict[param] = args[param]
 
-        else:
-            resp = jsonify({"message": "Unauthorized to update"})
-            resp.status_code = 401
+        if "schedule" in update_dict:
+            update_dict.update(schedule_columns(update_dict["schedule"]))
+
+        max_advisors = update_dict.get("max_advisors",
+                                       scrimmage.max_advisors)
+        if (max_advisors is not None and
+                len(scrimmage.advisors) > max_advisors):
+            db.session.rollback()
+            resp = jsonify({"message": "More advisors than max_advisors"})
+            resp.status_code = 409
             return resp
 
-        resp = jsonify(scrimmage.as_dict())
+        # Membership changes don't touch the scrimmage row, so the
+        # version is bumped explicitly for every update
+        update_dict.update(version_bump(Scrimmage))
+        updated = Scrimmage.query.filter_by(
+            id=id, version=expected_version).update(update_dict)
+        if not updated:
+            db.session.rollback()
+            current = db.session.query(Scrimmage.version).filter_by(
+                id=id).scalar()
+            if current is None:
+                return scrimmage_not_found()
+            return version_conflict(current)
+
+        if "subject" in update_dict or "scrimmage_type" in update_dict:
+            search.index_scrimmage(scrimmage)
+
+        db.session.commit()
+
+        # Check the members for double bookings whenever they or the times
+        # may have changed
+        members = []
+        if args["presenters"] or args["advisors"] or args["schedule"]:
+            members = ([u.id for u in scrimmage.presenters] +
+                       [u.id for u in scrimmage.advisors])
+        resp = jsonify(with_conflicts(scrimmage, members))
         resp.status_code = 200
         return resp
 
@@ -165,14 +338,67 @@ class Scrimmages(Resource):
     def delete(self, id):
         """ Delete a Scrimmage """
         # If I am an admin, OR one of the presenters, I can delete
-        user_id = flask_praetorian.current_user().id
-        user = User.query.filter_by(id=user_id).first()
+        user = flask_praetorian.current_user()
         scrimmage = Scrimmage.query.filter_by(id=id).first()
 
-        if (user in scrimmage.presenters or
-                'admin' in flask_praetorian.current_user().roles):
+        if user in scrimmage.presenters or user.is_admin():
             Scrimmage.query.filter_by(id=id).delete()
+            search.unindex_scrimmage(id)
             db.session.commit()
             return 'Scrimmage Deleted', 204
 
         return 'UNAUTHORIZED', 401
+
+
+@api.route('/Scrimmages/<int:id>/Advisors')
+class ScrimmageAdvisors(Resource):
+    @flask_praetorian.auth_required
+    def post(self, id):
+        """ Adds one advisor to a Scrimmage if it has a free seat """
+        parser = reqparse.RequestParser()
+        parser.add_argument('advisor_id', required=True, type=int)
+        args = parser.parse_args()
+
+        scrimmage = Scrimmage.query.get(id)
+        if scrimmage is None:
+            return scrimmage_not_found()
+
+        # Admins and presenters may add anyone, advisors only themselves
+        # and only where their invite has not been declined
+        user = flask_praetorian.current_user()
+        invite = None
+        if not (user in scrimmage.presenters or user.is_admin()):
+            if user.id == args["advisor_id"]:
+                invite = ScrimmageInvite.query.filter_by(
+                    scrimmage_id=id, advisor_id=user.id).filter(
+                    db.or_(ScrimmageInvite.responded.is_(None),
+                           ScrimmageInvite.accepted.is_(True))).first()
+            if invite is None:
+                resp = jsonify({"message": "Unauthorized to update"})
+                resp.status_code = 401
+                return resp
+
+        if User.with_role([args["advisor_id"]], 'advisor') is None:
+            resp = jsonify({"message": "Unable to locate or invalid user for advisor"})
+            resp.status_code = 400
+            return resp
+
+        added = Scrimmage.add_advisor(id, args["advisor_id"])
+        if added and invite is not None and invite.responded is None:
+            # Joining answers the invite, as accepting it would
+            invite.accepted = True
+            invite.responded = datetime.datetime.utcnow()
+        db.session.commit()
+
+        scrimmage = Scrimmage.with_members().filter_by(id=id).first()
+        ret = with_conflicts(scrimmage, [args["advisor_id"]] if added else [])
+        if added:
+            status = 201
+        elif args["advisor_id"] in ret["advisors"]:
+            status = 200
+        else:
+            ret = {"message": "Scrimmage is full"}
+            status = 409
+        resp = jsonify(ret)
+        resp.status_code = status
+        return resp
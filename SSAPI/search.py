@@ -0,0 +1,100 @@
+import re
+from sqlalchemy import DDL, column, event, table, text
+from SSAPI import db
+from SSAPI.models import Scrimmage
+
+# FTS5 index of Scrimmage.subject and scrimmage_type, rowid = scrimmage id
+fts = table('scrimmage_fts', column('rowid'), column('subject'),
+            column('scrimmage_type'))
+# bm25 weights per indexed column: a subject hit counts double
+RANK = text('bm25(scrimmage_fts, 2.0, 1.0)')
+TERM = re.compile(r'\w+\*?', re.UNICODE)
+
+event.listen(Scrimmage.__table__, 'after_create', DDL(
+    'CREATE VIRTUAL TABLE IF NOT EXISTS scrimmage_fts USING '
+    "fts5(subject, scrimmage_type, tokenize='unicode61')"
+).execute_if(dialect='sqlite'))
+event.listen(Scrimmage.__table__, 'before_drop', DDL(
+    'DROP TABLE IF EXISTS scrimmage_fts').execute_if(dialect='sqlite'))
+
+
+def enabled():
+    """ FTS5 is SQLite only; other databases skip the index """
+    return db.engine.dialect.name == 'sqlite'
+
+
+def index_row(connection, scrimmage_id, subject, scrimmage_type):
+    connection.execute(text(
+        'INSERT OR REPLACE INTO scrimmage_fts '
+        '(rowid, subject, scrimmage_type) VALUES (:id, :subject, :type)'),
+        id=scrimmage_id, subject=subject, type=scrimmage_type)
+
+
+def index_scrimmage(scrimmage):
+    """ Refreshes scrimmage in the search index after a bulk UPDATE
+
+    ORM inserts, updates and deletes keep the index in step through the
+    mapper events below; Query.update() and Query.delete() skip those, so
+    their callers use this and unindex_scrimmage. The caller commits.
+    """
+    if enabled():
+        index_row(db.session.connection(), scrimmage.id, scrimmage.subject,
+                  scrimmage.scrimmage_type)
+
+
+def unindex_scrimmage(scrimmage_id):
+    if enabled():
+        db.session.execute('DELETE FROM scrimmage_fts WHERE rowid = :id',
+                           {'id': scrimmage_id})
+
+
+@event.listens_for(Scrimmage, 'after_insert')
+@event.listens_for(Scrimmage, 'after_update')
+def sync_scrimmage(mapper, connection, target):
+    if connection.dialect.name == 'sqlite':
+        index_row(connection, target.id, target.subject,
+                  target.scrimmage_type)
+
+
+@event.listens_for(Scrimmage, 'after_delete')
+def drop_scrimmage(mapper, connection, target):
+    if connection.dialect.name == 'sqlite':
+        connection.execute(text('DELETE FROM scrimmage_fts WHERE rowid = :id'),
+                           id=target.id)
+
+
+def rebuild_index():
+    """ Re-creates the search index from the scrimmage table """
+    db.session.execute(
+        'CREATE VIRTUAL TABLE IF NOT EXISTS scrimmage_fts USING '
+        "fts5(subject, scrimmage_type, tokenize='unicode61')")
+    db.session.execute('DELETE FROM scrimmage_fts')
+    count = db.session.execute(
+        'INSERT INTO scrimmage_fts (rowid, subject, scrimmage_type) '
+        'SELECT id, subject, scrimmage_type FROM scrimmage').rowcount
+    db.session.commit()
+    return count
+
+
+def match_expression(q, prefix=False):
+    """ FTS5 query for the words in q, or None if it has none
+
+    Each word is quoted so FTS5 operators typed by users are taken as
+    text. A trailing * (or prefix=True for the last word) matches any word
+    starting with it, for typeahead.
+    """
+    terms = TERM.findall(q)
+    if not terms:
+        return None
+    if prefix and not terms[-1].endswith('*'):
+        terms[-1] += '*'
+    return ' '.join('"%s"%s' % (term.rstrip('*'),
+                                '*' if term.endswith('*') else '')
+                    for term in terms)
+
+
+def search(query, expression):
+    """ Narrows a Scrimmage query to matches of expression, best first """
+    return query.join(fts, fts.c.rowid == Scrimmage.id).filter(
+        text('scrimmage_fts MATCH :match')).params(
+        match=expression).order_by(RANK)
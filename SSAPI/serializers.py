@@ -0,0 +1,64 @@
+from operator import attrgetter
+from SSAPI import db
+
+# Stay well under SQLite's limit on bound parameters per statement
+IN_CHUNK_SIZE = 500
+
+
+class ModelSerializer():
+    """ Converts model instances or row tuples to dicts
+
+    The column names and accessors are resolved once, when the serializer
+    is created, instead of walking ``__table__.columns`` on every call.
+    ``collections`` maps an output key to a (parent id column, child id
+    column) pair used to list related ids, e.g. a scrimmage's presenters.
+    """
+
+    def __init__(self, model, exclude=(), collections=None):
+        self.model = model
+        self.keys = tuple(c.name for c in model.__table__.columns
+                          if c.name not in exclude)
+        self.columns = tuple(getattr(model, k) for k in self.keys)
+        self.collections = collections or {}
+        self._getter = attrgetter(*self.keys)
+        self._collection_getters = tuple(
+            (name, attrgetter(name)) for name in self.collections)
+
+    def query(self):
+        """ Query returning plain row tuples in serializer column order """
+        return db.session.query(*self.columns)
+
+    def dump(self, obj):
+        values = self._getter(obj)
+        if len(self.keys) == 1:
+            values = (values,)
+        ret = dict(zip(self.keys, values))
+        for name, getter in self._collection_getters:
+            ret[name] = [related.id for related in getter(obj)]
+        return ret
+
+    def dump_row(self, row):
+        return dict(zip(self.keys, row))
+
+    def dump_rows(self, rows):
+        """ Serializes row tuples, batch loading related ids for all rows """
+        keys = self.keys
+        ret = [dict(zip(keys, row)) for row in rows]
+        if not self.collections or not ret:
+            return ret
+
+        by_id = {}
+        for item in ret:
+            for name in self.collections:
+                item[name] = []
+            by_id[item['id']] = item
+
+        ids = list(by_id)
+        for name, (parent_col, child_col) in self.collections.items():
+            for start in range(0, len(ids), IN_CHUNK_SIZE):
+                chunk = ids[start:start + IN_CHUNK_SIZE]
+                related = db.session.query(parent_col, child_col).filter(
+                    parent_col.in_(chunk))
+                for parent_id, child_id in related:
+                    by_id[parent_id][name].append(child_id)
+        return ret
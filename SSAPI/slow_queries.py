@@ -0,0 +1,91 @@
+import json
+import logging
+import time
+from flask import current_app, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+
+def parameter_shape(parameters, executemany=False):
+    """ Type names of the bound parameters, never their values """
+    if executemany:
+        return {'rows': len(parameters),
+                'each': parameter_shape(parameters[0]) if parameters else []}
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__
+                for name, value in sorted(parameters.items())}
+    return [type(value).__name__ for value in parameters or ()]
+
+
+def current_view():
+    """ Name of the view handling this request, e.g. ScrimmageList.get """
+    if not has_request_context() or request.endpoint is None:
+        return None
+    view = current_app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    if view_class is None:
+        return request.endpoint
+    return '%s.%s' % (view_class.__name__, request.method.lower())
+
+
+def explain(conn, statement, parameters, executemany):
+    """ Query plan of statement, asked on the connection that ran it """
+    if conn.dialect.name == 'sqlite':
+        prefix, column = 'EXPLAIN QUERY PLAN ', -1
+    else:
+        prefix, column = 'EXPLAIN ', 0
+    if executemany:
+        parameters = parameters[0] if parameters else ()
+    # Straight to the DBAPI connection so the EXPLAIN is not itself logged
+    cursor = conn.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters or ())
+        return [row[column] for row in cursor.fetchall()]
+    except Exception as exc:
+        return ['EXPLAIN failed: %s' % exc]
+    finally:
+        cursor.close()
+
+
+class SlowQueryLog():
+    """ Logs statements slower than threshold seconds; None disables it """
+
+    def __init__(self, threshold=None):
+        self.threshold = threshold
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        if self.threshold is not None:
+            conn.info.setdefault('_slow_query_start', []).append(
+                time.perf_counter())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        starts = conn.info.get('_slow_query_start')
+        if not starts:
+            return
+        elapsed = time.perf_counter() - starts.pop()
+        if self.threshold is None or elapsed < self.threshold:
+            return
+        logger.warning(json.dumps({
+            'duration_ms': round(elapsed * 1000, 2),
+            'view': current_view(),
+            'statement': statement,
+            'parameters': parameter_shape(parameters, executemany),
+            'plan': explain(conn, statement, parameters, executemany),
+        }))
+
+
+slow_query_log = SlowQueryLog()
+event.listen(Engine, 'before_cursor_execute',
+             slow_query_log.before_cursor_execute)
+event.listen(Engine, 'after_cursor_execute',
+             slow_query_log.after_cursor_execute)
+
+
+def init_app(app):
+    """ Sets the threshold from SLOW_QUERY_MS; 0 turns the log off """
+    ms = app.config['SLOW_QUERY_MS']
+    slow_query_log.threshold = ms / 1000.0 if ms > 0 else None
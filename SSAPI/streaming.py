@@ -0,0 +1,60 @@
+from itertools import islice
+from flask import Response, current_app, request, stream_with_context
+from flask_restplus import inputs
+from SSAPI.json_backend import dumps
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def add_stream_arguments(parser):
+    """ Adds the argument that requests a streamed JSON array """
+    parser.add_argument('stream', type=inputs.boolean)
+    return parser
+
+
+def stream_requested(args):
+    """ Returns the mimetype to stream as, or None for a normal response """
+    best = request.accept_mimetypes.best_match(['application/json',
+                                                NDJSON_MIMETYPE])
+    if best == NDJSON_MIMETYPE:
+        return NDJSON_MIMETYPE
+    if args.get("stream"):
+        return 'application/json'
+    return None
+
+
+def iter_batches(query, batch_size):
+    """ Yields lists of up to batch_size rows read from a streaming cursor """
+    rows = iter(query.execution_options(stream_results=True)
+                .yield_per(batch_size))
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def stream_response(query, dump_rows, mimetype):
+    """ Streams query as a JSON array or NDJSON, one batch at a time
+
+    Only one batch of rows and its serialized form are held in memory, so
+    the response can be as large as the table without a memory spike.
+    """
+    batch_size = current_app.config['STREAM_BATCH_SIZE']
+    ndjson = mimetype == NDJSON_MIMETYPE
+
+    def generate():
+        first = True
+        if not ndjson:
+            yield '['
+        for batch in iter_batches(query, batch_size):
+            items = [dumps(item) for item in dump_rows(batch)]
+            if ndjson:
+                yield '\n'.join(items) + '\n'
+            else:
+                yield ('' if first else ',') + ','.join(items)
+            first = False
+        if not ndjson:
+            yield ']'
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
@@ -1,15 +1,26 @@
-from flask import Flask, request, jsonify
+import csv
+import io
+from flask import Flask, request
 from SSAPI.config import Config
-from SSAPI import app, api, db, guard
-from flask_restplus import Resource, Api
+from SSAPI import app, api, db, guard, hasher
+from flask_restplus import Resource, Api, reqparse
 from flask_sqlalchemy import SQLAlchemy
 import flask_praetorian
+from SSAPI.database import reads_from_replica
+from SSAPI.hashing import sheds_hash_load
+from SSAPI.json_backend import jsonify
 from SSAPI.models import *
+from SSAPI.conditional import conditional_get
+from SSAPI.pagination import (add_page_arguments, keyset_page, keyset_query,
+                              set_next_cursor)
+from SSAPI.streaming import (add_stream_arguments, stream_requested,
+                             stream_response)
 
 
 @api.route('/login')
 class Login(Resource):
 
+    @sheds_hash_load
     def post(self):
 
         req = request.get_json(force=True)
@@ -20,32 +31,61 @@ class Login(Resource):
             user = guard.authenticate(username, password)
             ret = {'access_token': guard.encode_jwt_token(user)}
             return jsonify(ret)
-        except Exception as e:
+        except flask_praetorian.exceptions.PraetorianError as e:
+            return e.jsonify()
+
+
+@api.route('/refresh')
+class Refresh(Resource):
+
+    def post(self):
+        """ Exchanges an expired access token for a new one
+
+        The token's refresh lifespan must not have run out. No password is
+        checked, so this is far cheaper than logging in again.
+        """
+        try:
+            old_token = guard.read_token_from_header()
+            ret = {'access_token': guard.refresh_jwt_token(old_token)}
+            return jsonify(ret)
+        except flask_praetorian.exceptions.PraetorianError as e:
             return e.jsonify()
 
 
 @api.route('/Users')
 class UsersList(Resource):
     @flask_praetorian.auth_required
+    @reads_from_replica
     def get(self):
         """ Returns a list of users """
         # Filtering/sorting
-        filt = request.args.get("role", None)
+        parser = reqparse.RequestParser()
+        parser.add_argument('role', type=str, location="args")
+        add_page_arguments(parser)
+        add_stream_arguments(parser)
+        args = parser.parse_args()
+        filt = args["role"]
 
+        query = user_serializer.query()
         if filt:
-            all_users = User.query.filter(User.roles.like("%" + filt + "%"))
-        else:
-            all_users = User.query.all()
+            query = query.join(UserRole).filter(UserRole.name == filt)
+
+        mimetype = stream_requested(args)
+        if mimetype:
+            query = keyset_query(query, User.id, args["after"])
+            return stream_response(query, user_serializer.dump_rows, mimetype)
+
+        all_users, next_cursor = keyset_page(query, User.id,
+                                             args["limit"], args["after"])
 
-        # Generate list to return
-        ret = list()
-        for users in all_users:
-            ret.append(users.as_dict())
+        # Generate list to return, straight from the row tuples
+        ret = list(map(user_serializer.dump_row, all_users))
 
         resp = jsonify(ret)
         resp.status_code = 200
-        return resp
+        return set_next_cursor(resp, next_cursor)
 
+    @sheds_hash_load
     def post(self):
         """ Create a new User """
         req = request.get_json(force=True)
@@ -81,48 +121,184 @@ class UsersList(Resource):
         return resp
 
 
+def read_import_rows():
+    """ Rows of a bulk import from a CSV upload or body, or a JSON array """
+    upload = request.files.get('file')
+    if upload is not None:
+        text = upload.read().decode('utf-8-sig')
+    elif request.mimetype == 'text/csv':
+        text = request.get_data(as_text=True)
+    else:
+        rows = request.get_json(force=True, silent=True)
+        return rows if isinstance(rows, list) else None
+    return list(csv.DictReader(io.StringIO(text)))
+
+
+# Row fields of a bulk import, each text when given
+IMPORT_FIELDS = ('username', 'password', 'firstname', 'lastname', 'roles')
+
+
+def non_text_fields(row):
+    return [name for name in IMPORT_FIELDS
+            if row.get(name) is not None and not isinstance(row[name], str)]
+
+
+def import_result(row, status, username=None, message=None, id=None):
+    result = {"row": row, "status": status, "username": username}
+    if message:
+        result["message"] = message
+    if id is not None:
+        result["id"] = id
+    return result
+
+
+@api.route('/Users/Import')
+class UsersImport(Resource):
+    @flask_praetorian.auth_required
+    @sheds_hash_load
+    def post(self):
+        """ Create many users from a JSON array or CSV upload """
+        if not flask_praetorian.current_user().is_admin():
+            return 'UNAUTHORIZED', 401
+
+        rows = read_import_rows()
+        if rows is None:
+            resp = jsonify({"message": "Expected a JSON array or CSV upload"})
+            resp.status_code = 400
+            return resp
+
+        results = [None] * len(rows)
+        pending = []
+        seen = set()
+        for index, row in enumerate(rows):
+            if not isinstance(row, dict):
+                results[index] = import_result(index, 400,
+                                               message="Invalid row")
+                continue
+            invalid = non_text_fields(row)
+            if invalid:
+                results[index] = import_result(
+                    index, 400, row.get('username'),
+                    "Expected text for " + ", ".join(invalid))
+                continue
+            username = row.get('username')
+            roles = row.get('roles') or ''
+            if not username or not row.get('password'):
+                results[index] = import_result(
+                    index, 400, username, "Missing username or password")
+            elif "admin" in roles:
+                # Do not allow admin users to be created, as in UsersList.post
+                results[index] = import_result(
+                    index, 412, username, "Admin users cannot be created")
+            elif username in seen:
+                results[index] = import_result(
+                    index, 409, username, "Duplicate username in import")
+            else:
+                seen.add(username)
+                pending.append((index, row))
+
+        # Check every username against the table in one query
+        existing = User.ids_by_username(row['username'] for _, row in pending)
+        new_rows = []
+        for index, row in pending:
+            if row['username'] in existing:
+                results[index] = import_result(
+                    index, 409, row['username'], "User Already Exists")
+            else:
+                new_rows.append((index, row))
+
+        if new_rows:
+            hashes = hasher.hash_many(row['password'] for _, row in new_rows)
+            db.session.execute(User.__table__.insert(), [
+                {'username': row['username'], 'password': password,
+                 'firstname': row.get('firstname'),
+                 'lastname': row.get('lastname'),
+                 'roles': ','.join(parse_roles(row.get('roles'))),
+                 'is_active': True}
+                for (_, row), password in zip(new_rows, hashes)])
+
+            ids = User.ids_by_username(row['username'] for _, row in new_rows)
+            role_rows = [{'user_id': ids[row['username']], 'name': name}
+                         for _, row in new_rows
+                         for name in parse_roles(row.get('roles'))]
+            if role_rows:
+                db.session.execute(UserRole.__table__.insert(), role_rows)
+            db.session.commit()
+
+            for index, row in new_rows:
+                results[index] = import_result(index, 201, row['username'],
+                                               id=ids[row['username']])
+
+        resp = jsonify(results)
+        resp.status_code = 200
+        return resp
+
+
 @api.route('/Users/<int:id>')
 class Users(Resource):
     @flask_praetorian.auth_required
+    @reads_from_replica
     def get(self, id):
         """ Returns info about a user (minus password) """
-        user = User.query.filter_by(id=id).first()
-        return jsonify(user.as_dict())
+        def load():
+            user = User.query.filter_by(id=id).first()
+            return jsonify(user.as_dict())
+
+        return conditional_get(User, id, load)
 
     @flask_praetorian.auth_required
     def delete(self, id):
         """ Delete a User """
-        if (flask_praetorian.current_user().id == id or
-                'admin' in flask_praetorian.current_user().roles):
+        current_user = flask_praetorian.current_user()
+        if current_user.id == id or current_user.is_admin():
+            UserRole.query.filter_by(user_id=id).delete()
             User.query.filter_by(id=id).delete()
             db.session.commit()
+            User.forget(id)
             return 'User Deleted', 204
 
         return 'UNAUTHORIZED', 401
 
     @flask_praetorian.auth_required
+    @sheds_hash_load
     def post(self, id):
         """ Updates a User """
-        if (flask_praetorian.current_user().id == id or
-                'admin' in flask_praetorian.current_user().roles):
-            update_dict = {}
+        current_user = flask_praetorian.current_user()
+        if current_user.id == id or current_user.is_admin():
             req = request.get_json(force=True)
-            for param in list(req.keys()):
-                if "username" in param:
-                    # Don't allow username change to an existing username
-                    name_check = User.query.filter_by(username=req.get(param)).first()
-                    if name_check:
-                        return 'User Already Exists', 409
-                if "password" in param:
-                    update_dict[param] = guard.encrypt_password(req.get(param))
-                else:
-                    update_dict[param] = req.get(param)
+            unknown = set(req) - User.admin_updatable_columns
+            if unknown:
+                resp = jsonify({"message": "Unable to update field(s): " +
+                                ", ".join(sorted(unknown))})
+                resp.status_code = 400
+                return resp
 
-                User.query.filter_by(id=id).update(update_dict)
+            admin_only = set(req) - User.updatable_columns
+            if admin_only and not current_user.is_admin():
+                resp = jsonify({"message": "Only admins may update: " +
+                                ", ".join(sorted(admin_only))})
+                resp.status_code = 401
+                return resp
 
-                db.session.commit()
+            user = User.query.get(id)
+            if user is None:
+                return 'User Not Found', 404
 
-            user = User.query.filter_by(id=id).first()
+            if "password" in req:
+                req["password"] = guard.encrypt_password(req["password"])
+            changes = user.diff(req)
+
+            if "username" in changes:
+                # Don't allow username change to an existing username
+                name_check = User.query.filter(
+                    User.username == changes["username"], User.id != id).first()
+                if name_check:
+                    return 'User Already Exists', 409
+
+            # One UPDATE (plus the role index rows) and one commit
+            user.apply_changes(changes)
+            db.session.commit()
+            User.forget(id)
 
             resp = jsonify(user.as_dict())
             resp.status_code = 200
@@ -0,0 +1,101 @@
+""" Parallel advisor joins: read-modify-write versus the conditional INSERT
+
+Threads add advisors to a pool of scrimmages at the same time. The
+read-modify-write variant reproduces the old Scrimmages.post flow (load,
+check len(advisors), append, commit) and shows how often it overfills
+max_advisors; Scrimmage.add_advisor never should.
+
+Run from the repository root:  python -m benchmarks.bench_advisor_joins
+"""
+import os
+import random
+import threading
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from sqlalchemy.exc import OperationalError  # noqa: E402
+from SSAPI import app, db  # noqa: E402
+from SSAPI.models import Scrimmage, User, advisors  # noqa: E402
+
+THREADS = 8
+JOINS_PER_THREAD = 200
+SCRIMMAGES = 20
+MAX_ADVISORS = 5
+USERS = 2000
+
+
+def read_modify_write(scrimmage_id, user_id):
+    scrimmage = Scrimmage.query.get(scrimmage_id)
+    user = User.query.get(user_id)
+    if len(scrimmage.advisors) >= scrimmage.max_advisors or \
+            user in scrimmage.advisors:
+        db.session.rollback()
+        return False
+    scrimmage.advisors.append(user)
+    db.session.commit()
+    return True
+
+
+def conditional_insert(scrimmage_id, user_id):
+    added = Scrimmage.add_advisor(scrimmage_id, user_id)
+    db.session.commit()
+    return added
+
+
+def populate():
+    db.drop_all()
+    db.create_all()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user%d' % i, 'password': 'x',
+         'roles': 'advisor'} for i in range(1, USERS + 1)])
+    db.session.execute(Scrimmage.__table__.insert(), [
+        {'id': i, 'subject': 'Subject %d' % i, 'max_advisors': MAX_ADVISORS}
+        for i in range(1, SCRIMMAGES + 1)])
+    db.session.commit()
+
+
+def run(join):
+    with app.app_context():
+        populate()
+    errors = []
+
+    def worker(seed):
+        rng = random.Random(seed)
+        with app.app_context():
+            for _ in range(JOINS_PER_THREAD):
+                try:
+                    join(rng.randint(1, SCRIMMAGES), rng.randint(1, USERS))
+                except OperationalError:
+                    db.session.rollback()
+                    errors.append(1)
+            db.session.remove()
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(THREADS)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    with app.app_context():
+        counts = db.session.query(db.func.count()).select_from(
+            advisors).group_by(advisors.c.scrimmage_id).all()
+        overfilled = sum(1 for (count,) in counts if count > MAX_ADVISORS)
+        seats = sum(count for (count,) in counts)
+    return THREADS * JOINS_PER_THREAD / elapsed, overfilled, seats, \
+        len(errors)
+
+
+def main():
+    for name, join in (('read-modify-write', read_modify_write),
+                       ('conditional insert', conditional_insert)):
+        rate, overfilled, seats, errors = run(join)
+        print("%-20s %8.0f joins/s  %3d seats taken  %2d overfilled  "
+              "%3d lock errors" % (name, rate, seats, overfilled, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+""" Time to assign 10k advisors to 5k scrimmages
+
+Each advisor holds a handful of invites (accepted, pending or declined).
+Reports loading the problem, scoring the pairs, the greedy pass plus
+augmenting paths, and the fill pass.
+
+Run from the repository root:  python -m benchmarks.bench_assignment
+"""
+import datetime
+import os
+import random
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from SSAPI import app, db  # noqa: E402
+from SSAPI import assignment  # noqa: E402
+from SSAPI.models import (Scrimmage, ScrimmageInvite, User,  # noqa: E402
+                          UserRole, presenters)
+
+ADVISORS = 10000
+SCRIMMAGES = 5000
+MAX_ADVISORS = 3
+INVITES_PER_ADVISOR = 5
+
+
+def populate():
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(1)
+    now = datetime.datetime.utcnow()
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user%d' % i, 'password': 'x',
+         'roles': 'advisor'} for i in range(1, ADVISORS + 1)])
+    db.session.execute(UserRole.__table__.insert(), [
+        {'user_id': i, 'name': 'advisor'} for i in range(1, ADVISORS + 1)])
+    db.session.execute(Scrimmage.__table__.insert(), [
+        {'id': i, 'subject': 'Subject %d' % i, 'scrimmage_complete': False,
+         'max_advisors': MAX_ADVISORS} for i in range(1, SCRIMMAGES + 1)])
+    db.session.execute(presenters.insert(), [
+        {'user_id': rng.randint(1, ADVISORS), 'scrimmage_id': i}
+        for i in range(1, SCRIMMAGES + 1)])
+    invites = []
+    for advisor_id in range(1, ADVISORS + 1):
+        for scrimmage_id in rng.sample(range(1, SCRIMMAGES + 1),
+                                       INVITES_PER_ADVISOR):
+            state = rng.random()
+            invites.append({'advisor_id': advisor_id,
+                            'scrimmage_id': scrimmage_id,
+                            'accepted': state < 0.4,
+                            'responded': None if state > 0.8 else
+                            now})
+    db.session.execute(ScrimmageInvite.__table__.insert(), invites)
+    db.session.commit()
+
+
+def timed(label, func, *args):
+    start = time.perf_counter()
+    ret = func(*args)
+    print("%-28s %9.1f ms" % (label, (time.perf_counter() - start) * 1000))
+    return ret
+
+
+def main():
+    with app.app_context():
+        populate()
+        problem = timed('load problem', assignment.Problem, 1)
+        args = (problem.pair_advisors, problem.pair_scrimmages,
+                problem.pair_sources, problem.load, problem.fill)
+        print("%d candidate pairs, %d seats, %d advisors"
+              % (len(problem.pair_advisors), sum(problem.seats.values()),
+                 len(problem.capacity)))
+
+        scores = timed('score pairs', assignment.score_pairs, *args)
+
+        matching = assignment.Matching(problem.capacity, problem.seats)
+        timed('greedy pass', matching.add_pairs, problem.pair_advisors,
+              problem.pair_scrimmages, scores)
+        greedy = len(matching.pairs())
+        timed('augmenting paths', matching.maximize)
+        print("assigned %d greedily, %d after augmenting"
+              % (greedy, len(matching.pairs())))
+        filled = timed('fill pass', matching.fill, problem.excluded,
+                       problem.fill, problem.load)
+        print("filled %d more" % len(filled))
+
+        timed('solve (fill, end to end)', assignment.solve, 1, True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+""" Encoding throughput of the stdlib and orjson JSON backends
+
+Run from the repository root:  python -m benchmarks.bench_json
+"""
+import datetime
+import os
+import timeit
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from SSAPI import app  # noqa: E402
+from SSAPI.json_backend import OrjsonBackend, StdlibBackend, orjson  # noqa: E402
+
+ROWS = 5000
+
+
+def scrimmage_payload():
+    return [{'id': i, 'subject': 'Scrimmage %d' % i,
+             'schedule': '2019-04-23T18:25:43.511Z', 'scrimmage_type': 'Demo',
+             'scrimmage_complete': bool(i % 2), 'max_advisors': 5,
+             'presenters': [i, i + 1], 'advisors': list(range(i, i + 5)),
+             'invites': list(range(i, i + 3))}
+            for i in range(ROWS)]
+
+
+def invite_payload():
+    sent = datetime.datetime(2019, 4, 23, 18, 25, 43)
+    return [{'id': i, 'accepted': None, 'advisor_id': i, 'scrimmage_id': i,
+             'last_sent': sent, 'responded': sent + datetime.timedelta(hours=i)}
+            for i in range(ROWS)]
+
+
+def main():
+    backends = [StdlibBackend()]
+    if orjson is not None:
+        backends.append(OrjsonBackend())
+    else:
+        print("orjson is not installed, only timing the stdlib backend")
+
+    with app.app_context():
+        for label, payload in (('scrimmages', scrimmage_payload()),
+                               ('invites', invite_payload())):
+            for backend in backends:
+                best = min(timeit.repeat(lambda: backend.dumps(payload),
+                                         number=1, repeat=5))
+                print("%-10s %-7s %10.0f rows/s" % (label, backend.name,
+                                                    ROWS / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+""" Latency of GET /Scrimmages while a storm of logins hashes passwords
+
+Runs the app on a local threaded server, once hashing inline on the request
+threads and once on the bounded process pool (one subprocess each, since
+the pool is configured at import time).
+
+Run from the repository root:  python -m benchmarks.bench_login_storm
+"""
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from werkzeug.serving import make_server  # noqa: E402
+
+from SSAPI import app, db, guard, hasher  # noqa: E402
+from SSAPI.models import Scrimmage, User  # noqa: E402
+
+LOGIN_THREADS = 24
+DURATION = 5.0
+
+
+def request(base, path, body=None, token=None):
+    data = json.dumps(body).encode() if body is not None else None
+    req = urllib.request.Request(base + path, data=data)
+    req.add_header('Content-Type', 'application/json')
+    if token:
+        req.add_header('Authorization', 'Bearer ' + token)
+    try:
+        with urllib.request.urlopen(req) as resp:
+            return resp.status, resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+
+
+def setup_db():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='presenter', roles='presenter',
+                    password=guard.encrypt_password('presenter'))
+        db.session.add(user)
+        for i in range(50):
+            scrimmage = Scrimmage(subject='s%d' % i, max_advisors=5)
+            scrimmage.presenters.append(user)
+            db.session.add(scrimmage)
+        db.session.commit()
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct))]
+
+
+def run(base, token):
+    stop = time.monotonic() + DURATION
+    statuses = []
+    latencies = []
+
+    def login():
+        while time.monotonic() < stop:
+            status, _ = request(base, '/login', {'username': 'presenter',
+                                                 'password': 'presenter'})
+            statuses.append(status)
+
+    def probe():
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            request(base, '/Scrimmages', token=token)
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.01)
+
+    threads = [threading.Thread(target=login) for _ in range(LOGIN_THREADS)]
+    threads.append(threading.Thread(target=probe))
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    print("%-7s /Scrimmages p50 %6.1f ms  p99 %7.1f ms | logins ok %5d, "
+          "503 %5d" % ('pool' if hasher.workers else 'inline',
+                       percentile(latencies, 0.5) * 1000,
+                       percentile(latencies, 0.99) * 1000,
+                       statuses.count(200), statuses.count(503)))
+
+
+def scenario():
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.debug = False
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    setup_db()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = 'http://127.0.0.1:%d' % server.server_port
+
+    _, body = request(base, '/login', {'username': 'presenter',
+                                       'password': 'presenter'})
+    token = json.loads(body)['access_token']
+
+    run(base, token)
+    server.shutdown()
+    hasher.shutdown()
+
+
+def main():
+    workers = str(os.cpu_count() or 1)
+    for env in ({'PASSWORD_HASH_WORKERS': '0'},
+                {'PASSWORD_HASH_WORKERS': workers,
+                 'PASSWORD_HASH_QUEUE_DEPTH': workers}):
+        subprocess.check_call([sys.executable, '-m', __spec__.name, 'run'],
+                              env=dict(os.environ, **env))
+
+
+if __name__ == '__main__':
+    scenario() if sys.argv[1:] == ['run'] else main()
@@ -0,0 +1,75 @@
+""" Latency of the "scrimmages I belong to" query on a 100k scrimmage table
+
+Compares the previous correlated EXISTS filter (advisors.any() |
+presenters.any()) with the join against Scrimmage.member_ids, for the whole
+list and for a first page of 50.
+
+Run from the repository root:  python -m benchmarks.bench_member_filter
+"""
+import os
+import random
+import timeit
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from SSAPI import app, db  # noqa: E402
+from SSAPI.models import (Scrimmage, User, advisors, presenters,  # noqa: E402
+                          scrimmage_serializer)
+
+SCRIMMAGES = 100000
+USERS = 2000
+ADVISORS_PER_SCRIMMAGE = 2
+
+
+def populate():
+    db.drop_all()
+    db.create_all()
+    rng = random.Random(1)
+    db.session.execute(User.__table__.insert(), [
+        {'id': i, 'username': 'user%d' % i, 'password': 'x',
+         'roles': 'presenter,advisor'} for i in range(1, USERS + 1)])
+    db.session.execute(Scrimmage.__table__.insert(), [
+        {'id': i, 'subject': 'Subject %d' % i, 'schedule': '',
+         'scrimmage_type': 'type', 'scrimmage_complete': False,
+         'max_advisors': 5} for i in range(1, SCRIMMAGES + 1)])
+    db.session.execute(presenters.insert(), [
+        {'user_id': rng.randint(1, USERS), 'scrimmage_id': i}
+        for i in range(1, SCRIMMAGES + 1)])
+    db.session.execute(advisors.insert(), [
+        {'user_id': user_id, 'scrimmage_id': i}
+        for i in range(1, SCRIMMAGES + 1)
+        for user_id in rng.sample(range(1, USERS + 1),
+                                  ADVISORS_PER_SCRIMMAGE)])
+    db.session.commit()
+    db.session.execute('ANALYZE')
+
+
+def exists_query(user_id):
+    return scrimmage_serializer.query().filter(
+        (Scrimmage.advisors.any(User.id == user_id)) |
+        (Scrimmage.presenters.any(User.id == user_id)))
+
+
+def join_query(user_id):
+    members = Scrimmage.member_ids(user_id).alias('members')
+    return scrimmage_serializer.query().join(
+        members, members.c.scrimmage_id == Scrimmage.id)
+
+
+def main():
+    with app.app_context():
+        populate()
+        user_id = USERS // 2
+        for name, build in (('correlated EXISTS', exists_query),
+                            ('member_ids join', join_query)):
+            query = build(user_id).order_by(Scrimmage.id)
+            rows = len(query.all())
+            full = min(timeit.repeat(query.all, number=1, repeat=5))
+            page = query.limit(50)
+            first = min(timeit.repeat(page.all, number=1, repeat=5))
+            print("%-18s %5d rows  all %8.2f ms  first 50 %8.2f ms"
+                  % (name, rows, full * 1000, first * 1000))
+
+
+if __name__ == '__main__':
+    main()
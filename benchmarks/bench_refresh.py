@@ -0,0 +1,46 @@
+""" Requests per second of POST /refresh versus POST /login
+
+Run from the repository root:  python -m benchmarks.bench_refresh
+"""
+import os
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+import pendulum  # noqa: E402
+
+from SSAPI import app, db, guard  # noqa: E402
+from SSAPI.models import User  # noqa: E402
+
+REQUESTS = 200
+
+
+def rate(func):
+    start = time.perf_counter()
+    for _ in range(REQUESTS):
+        assert func().status_code == 200
+    return REQUESTS / (time.perf_counter() - start)
+
+
+def main():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='presenter', roles='presenter',
+                    password=guard.encrypt_password('presenter'))
+        db.session.add(user)
+        db.session.commit()
+        token = guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.duration(seconds=-10))
+
+    client = app.test_client()
+    login = rate(lambda: client.post('/login', json={
+        'username': 'presenter', 'password': 'presenter'}))
+    refresh = rate(lambda: client.post('/refresh', headers={
+        'Authorization': 'Bearer ' + token}))
+    print("login   %8.0f req/s" % login)
+    print("refresh %8.0f req/s" % refresh)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+""" Rows per second of the reflective as_dict versus the compiled serializer
+
+Run from the repository root:  python -m benchmarks.bench_serializers
+"""
+import os
+import timeit
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from SSAPI.models import User, user_serializer  # noqa: E402
+
+ROWS = 10000
+
+
+def reflective_as_dict(user):
+    # The previous User.as_dict implementation
+    return {c.name: getattr(user, c.name) for c in user.__table__.columns
+            if c.name not in "password"}
+
+
+def main():
+    users = [User(id=i, username='user%d' % i, password='x',
+                  firstname='First', lastname='Last', roles='advisor',
+                  is_active=True)
+             for i in range(ROWS)]
+    rows = [tuple(getattr(u, k) for k in user_serializer.keys) for u in users]
+
+    cases = [
+        ('reflective as_dict', lambda: [reflective_as_dict(u) for u in users]),
+        ('serializer dump', lambda: [user_serializer.dump(u) for u in users]),
+        ('serializer dump_row', lambda: [user_serializer.dump_row(r)
+                                         for r in rows]),
+    ]
+    for name, func in cases:
+        best = min(timeit.repeat(func, number=1, repeat=5))
+        print("%-22s %12.0f rows/s" % (name, ROWS / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+""" Mixed read/write throughput of SQLite from many threads
+
+Compares SQLAlchemy's SQLite defaults (NullPool, rollback journal) with the
+settings SSAPI.database applies (QueuePool, WAL and the configured pragmas).
+
+Run from the repository root:  python -m benchmarks.bench_sqlite_concurrency
+"""
+import os
+import random
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from sqlalchemy import create_engine, event  # noqa: E402
+from sqlalchemy.exc import OperationalError  # noqa: E402
+
+from SSAPI import app  # noqa: E402
+from SSAPI.database import apply_sqlite_pragmas, engine_options  # noqa: E402
+
+THREADS = 16
+OPS_PER_THREAD = 300
+WRITE_RATIO = 0.2
+
+
+def make_engine(path, tuned):
+    uri = 'sqlite:///' + path
+    if not tuned:
+        # Short timeout so lock contention shows up as errors, not hangs
+        return create_engine(uri, connect_args={'timeout': 1})
+    engine = create_engine(uri, **engine_options(app.config, uri))
+    pragmas = app.config['SQLITE_PRAGMAS']
+    event.listen(engine, 'connect',
+                 lambda conn, record: apply_sqlite_pragmas(conn, pragmas))
+    return engine
+
+
+def run(tuned):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    engine = make_engine(path, tuned)
+    engine.execute('CREATE TABLE scrimmage (id INTEGER PRIMARY KEY, '
+                   'subject TEXT, max_advisors INTEGER)')
+    engine.execute('INSERT INTO scrimmage (subject, max_advisors) VALUES ' +
+                   ','.join(["('s%d', 5)" % i for i in range(1000)]))
+
+    errors = []
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        for _ in range(OPS_PER_THREAD):
+            try:
+                if rnd.random() < WRITE_RATIO:
+                    with engine.begin() as conn:
+                        conn.execute('UPDATE scrimmage SET max_advisors = '
+                                     'max_advisors + 1 WHERE id = ?',
+                                     rnd.randint(1, 1000))
+                else:
+                    with engine.connect() as conn:
+                        conn.execute('SELECT * FROM scrimmage WHERE id >= ? '
+                                     'LIMIT 20', rnd.randint(1, 1000)).fetchall()
+            except OperationalError:
+                errors.append(1)
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(THREADS)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.unlink(path + suffix)
+    return THREADS * OPS_PER_THREAD / elapsed, len(errors)
+
+
+def main():
+    for label, tuned in (('defaults', False), ('tuned', True)):
+        ops, errors = run(tuned)
+        print("%-9s %8.0f ops/s  %4d locked errors" % (label, ops, errors))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+""" Throughput of five-field user updates: per-field commits versus one diff
+
+The per-field variant reproduces the old Users.post loop, which issued an
+UPDATE and a commit for every key in the request.
+
+Run from the repository root:  python -m benchmarks.bench_user_update
+"""
+import os
+import time
+
+os.environ.setdefault('APP_SETTINGS', 'testing')
+
+from SSAPI import app, db  # noqa: E402
+from SSAPI.models import User  # noqa: E402
+
+UPDATES = 300
+USERS = 50
+
+
+def request_body(i):
+    return {'username': 'user%d' % (i % USERS), 'firstname': 'First%d' % i,
+            'lastname': 'Last%d' % i, 'is_active': bool(i % 2),
+            'roles': 'advisor' if i % 2 else 'advisor,presenter'}
+
+
+def per_field_update(user_id, req):
+    update_dict = {}
+    for param in list(req.keys()):
+        if "username" in param:
+            User.query.filter_by(username=req.get(param)).first()
+        update_dict[param] = req.get(param)
+        User.query.filter_by(id=user_id).update(update_dict)
+        db.session.commit()
+
+
+def single_diff_update(user_id, req):
+    user = User.query.get(user_id)
+    changes = user.diff(req)
+    if "username" in changes:
+        User.query.filter(User.username == changes["username"],
+                          User.id != user_id).first()
+    user.apply_changes(changes)
+    db.session.commit()
+
+
+def run(update):
+    db.drop_all()
+    db.create_all()
+    for i in range(USERS):
+        db.session.add(User(username='user%d' % i, password='x',
+                            roles='advisor'))
+    db.session.commit()
+
+    start = time.perf_counter()
+    for i in range(UPDATES):
+        update(i % USERS + 1, request_body(i))
+    return UPDATES / (time.perf_counter() - start)
+
+
+def main():
+    with app.app_context():
+        for label, update in (('per-field commits', per_field_update),
+                              ('single diff', single_diff_update)):
+            print("%-18s %8.0f updates/s" % (label, run(update)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,9 @@
+from SSAPI import app, db
+from SSAPI.migrations import upgrade
+
+report = upgrade()
+print("Added columns: %s" % (", ".join(report['columns']) or "none"))
+print("Populated %d user roles" % report['roles'])
+print("Added indexes: %s" % (", ".join(report['indexes']) or "none"))
+print("Parsed %d scrimmage schedules" % report['schedules'])
+print("Indexed %d scrimmages for search" % report['search'])
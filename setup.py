@@ -10,4 +10,7 @@ setup(
         'flask-jwt',
         'flask-sqlalchemy',
     ],
+    extras_require={
+        'fastjson': ['orjson'],
+    },
 )
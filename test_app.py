@@ -2,8 +2,11 @@ import os
 import tempfile
 import pytest
 import base64
+import io
 import json
+from contextlib import contextmanager
 from flask import request, jsonify
+from sqlalchemy import event
 
 os.environ['APP_SETTINGS'] = "testing"
 
@@ -55,6 +58,23 @@ def client():
     os.unlink(app.config['DATABASE'])
 
 
+@contextmanager
+def count_statements():
+    """ Collects the SQL statements issued against the engine """
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
 # -----------------------------
 # User Management Tests
 # -----------------------------
@@ -588,4 +608,1661 @@ def test_scrimmage_add_nonadvisor(client):
 
 
 def test_scrimmage_add_toomany_advisors(client):
-    pass
\ No newline at end of file
+    token = login_client_helper(client, 'admin', 'admin')
+
+    rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [2],
+                                          'max_advisors': 1},
+                     headers=token)
+    assert '200' in rv.status
+
+    rv = client.post('/Scrimmages/1', json={'advisors': [3, 1]},
+                     headers=token)
+
+    assert '409' in rv.status
+    rv = client.get('/Scrimmages/1', headers=token)
+    assert rv.get_json()['advisors'] == []
+
+
+def test_list_scrimmages_constant_queries(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    def create_scrimmage():
+        rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                              'schedule': '2019-04-23T18:25:43.511Z',
+                                              'scrimmage_type': 'Demo',
+                                              'presenters': [2],
+                                              'max_advisors': 1},
+                         headers=token)
+        assert '200' in rv.status
+        client.post('/Scrimmages/%d' % rv.get_json()['id'],
+                    json={'advisors': [3]}, headers=token)
+
+    create_scrimmage()
+    with count_statements() as statements:
+        rv = client.get('/Scrimmages', data={'all': True}, headers=token)
+    assert len(rv.get_json()) == 1
+    single = len(statements)
+
+    for _ in range(4):
+        create_scrimmage()
+    with count_statements() as statements:
+        rv = client.get('/Scrimmages', data={'all': True}, headers=token)
+    data = rv.get_json()
+    assert len(data) == 5
+    assert all(d['presenters'] == [2] and d['advisors'] == [3] for d in data)
+    assert len(statements) == single
+
+
+def test_get_specific_scrimmage_queries(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [1, 2],
+                                          'max_advisors': 1},
+                     headers=token)
+    assert '200' in rv.status
+
+    with count_statements() as statements:
+        rv = client.get('/Scrimmages/1', headers=token)
+    assert '200' in rv.status
+    # Token user, scrimmage, and one batch each for presenters/advisors/invites
+    assert len(statements) <= 5
+
+def test_list_scrimmages_paginated(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    for _ in range(5):
+        rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                              'schedule': '2019-04-23T18:25:43.511Z',
+                                              'scrimmage_type': 'Demo',
+                                              'presenters': [2],
+                                              'max_advisors': 1},
+                         headers=token)
+        assert '200' in rv.status
+
+    rv = client.post('/Scrimmages/4', json={'scrimmage_complete': True},
+                     headers=token)
+    assert '200' in rv.status
+
+    seen = []
+    after = None
+    while True:
+        query = {'all': True, 'scrimmage_complete': False, 'limit': 2}
+        if after is not None:
+            query['after'] = after
+        rv = client.get('/Scrimmages', query_string=query, headers=token)
+        assert '200' in rv.status
+        data = rv.get_json()
+        assert len(data) <= 2
+        seen.extend(d['id'] for d in data)
+        after = rv.headers.get('X-Next-Cursor')
+        if after is None:
+            break
+
+    assert seen == [1, 2, 3, 5]
+
+
+def test_list_users_paginated(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    rv = client.get('/Users', query_string={'limit': 2}, headers=token)
+    assert '200' in rv.status
+    assert [d['id'] for d in rv.get_json()] == [1, 2]
+    assert rv.headers['X-Next-Cursor'] == '2'
+
+    rv = client.get('/Users', query_string={'limit': 2, 'after': 2},
+                    headers=token)
+    assert [d['id'] for d in rv.get_json()] == [3]
+    assert 'X-Next-Cursor' not in rv.headers
+
+    rv = client.get('/Users', query_string={'role': 'presenter', 'limit': 1,
+                                            'after': 1},
+                    headers=token)
+    assert [d['id'] for d in rv.get_json()] == [2]
+
+
+def test_list_users_bad_limit(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    rv = client.get('/Users', query_string={'limit': 0}, headers=token)
+    assert '400' in rv.status
+
+
+def test_list_users_role_exact_match(client):
+    rv = client.post('/Users', json={'username': 'coach',
+                                     'password': 'coach',
+                                     'firstname': 'Coach',
+                                     'lastname': 'User',
+                                     'roles': 'headadvisor'})
+    assert '200' in rv.status
+
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.get('/Users', query_string={'role': 'advisor'}, headers=token)
+    assert '200' in rv.status
+    assert [d['id'] for d in rv.get_json()] == [1, 3]
+
+
+def test_change_user_roles(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Users/3', json={'roles': 'advisor, presenter'},
+                     headers=token)
+    assert '200' in rv.status
+    assert rv.get_json()['roles'] == 'advisor,presenter'
+
+    rv = client.get('/Users', query_string={'role': 'presenter'},
+                    headers=token)
+    assert [d['id'] for d in rv.get_json()] == [1, 2, 3]
+
+    rv = client.post('/Users/3', json={'roles': 'advisor'}, headers=token)
+    assert '200' in rv.status
+    rv = client.get('/Users', query_string={'role': 'presenter'},
+                    headers=token)
+    assert [d['id'] for d in rv.get_json()] == [1, 2]
+
+
+def test_user_role_checks():
+    user = User(roles='presenter,advisor')
+    assert user.rolenames == ['presenter', 'advisor']
+    assert user.has_role('advisor')
+    assert not user.has_role('admin')
+    assert not user.is_admin()
+
+    user.roles = 'admin'
+    assert user.is_admin()
+    assert [r.name for r in user.role_entries] == ['admin']
+
+
+def test_populate_user_roles(client):
+    from SSAPI.migrations import populate_user_roles
+    from SSAPI.models import UserRole
+
+    with app.app_context():
+        UserRole.query.delete()
+        db.session.commit()
+
+        assert populate_user_roles() == 5
+        names = [r.name for r in UserRole.query.filter_by(user_id=1)]
+        assert sorted(names) == ['admin', 'advisor', 'presenter']
+
+
+def test_ttl_cache_expiry_and_lru():
+    from SSAPI.cache import TTLCache
+
+    now = [0.0]
+    cache = TTLCache(2, 10, timer=lambda: now[0])
+    cache.set(1, 'a')
+    cache.set(2, 'b')
+    assert cache.get(1) == 'a'
+    cache.set(3, 'c')  # evicts 2, the least recently used
+    assert cache.get(2) is None
+    assert cache.get(1) == 'a'
+
+    now[0] = 10.0
+    assert cache.get(1) is None
+    assert cache.get(3) is None
+
+    disabled = TTLCache(2, 0)
+    disabled.set(1, 'a')
+    assert disabled.get(1) is None
+
+
+@pytest.fixture
+def identity_cache():
+    from SSAPI.models import identity_cache
+
+    identity_cache.clear()
+    identity_cache.ttl = 60
+    yield identity_cache
+    identity_cache.ttl = app.config['IDENTITY_CACHE_TTL']
+    identity_cache.clear()
+
+
+def test_identity_cache_skips_user_lookup(client, identity_cache):
+    token = login_client_helper(client, 'presenter', 'presenter')
+
+    rv = client.get('/Scrimmages', headers=token)
+    assert '200' in rv.status
+    assert identity_cache.get(2) is not None
+
+    with count_statements() as statements:
+        rv = client.get('/Scrimmages', headers=token)
+    assert '200' in rv.status
+    assert not any('FROM user' in s and 'WHERE user.id = ?' in s
+                   for s in statements)
+
+
+def test_identity_cache_invalidated_on_change(client, identity_cache):
+    token = login_client_helper(client, 'presenter', 'presenter')
+
+    rv = client.post('/Users/2', json={'firstname': 'Changed'},
+                     headers=token)
+    assert '200' in rv.status
+    assert identity_cache.get(2) is None
+
+    rv = client.get('/Scrimmages', headers=token)
+    assert identity_cache.get(2).firstname == 'Changed'
+
+    rv = client.delete('/Users/2', headers=token)
+    assert '204' in rv.status
+    assert identity_cache.get(2) is None
+
+    rv = client.get('/Scrimmages', headers=token)
+    assert '401' in rv.status
+
+
+def test_create_scrimmage_unknown_presenter(client):
+    token = login_client_helper(client, 'presenter', 'presenter')
+
+    rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [2, 99],
+                                          'max_advisors': 1},
+                     headers=token)
+
+    assert '400' in rv.status
+    assert 'presenter' in rv.get_json()['message']
+
+
+def test_scrimmage_set_advisors_single_query(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    for i in range(10):
+        rv = client.post('/Users', json={'username': 'advisor%d' % i,
+                                         'password': 'advisor',
+                                         'firstname': 'Advisor',
+                                         'lastname': str(i),
+                                         'roles': 'advisor'})
+        assert '200' in rv.status
+
+    rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [2],
+                                          'max_advisors': 20},
+                     headers=token)
+    assert '200' in rv.status
+
+    advisor_ids = list(range(4, 14))
+    with count_statements() as statements:
+        rv = client.post('/Scrimmages/1', json={'advisors': advisor_ids},
+                         headers=token)
+    assert '200' in rv.status
+    assert sorted(rv.get_json()['advisors']) == advisor_ids
+    lookups = [s for s in statements if 'FROM user' in s and ' IN (' in s]
+    assert len(lookups) == 1
+
+    rv = client.post('/Scrimmages/1', json={'advisors': [4, 99]},
+                     headers=token)
+    assert '400' in rv.status
+
+
+def test_serializer_rows_match_orm(client):
+    from SSAPI.models import Scrimmage, scrimmage_serializer, user_serializer
+
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [1, 2],
+                                          'max_advisors': 1},
+                     headers=token)
+    assert '200' in rv.status
+    rv = client.post('/Scrimmages/1', json={'advisors': [3]}, headers=token)
+    assert '200' in rv.status
+
+    with app.app_context():
+        orm = Scrimmage.query.get(1).as_dict()
+        rows = scrimmage_serializer.dump_rows(scrimmage_serializer.query())
+        assert len(rows) == 1
+        rows[0]['presenters'].sort()
+        orm['presenters'].sort()
+        assert rows[0] == orm
+
+        user = User.query.get(1).as_dict()
+        assert 'password' not in user
+        row = user_serializer.dump_row(
+            user_serializer.query().filter(User.id == 1).one())
+        assert row == user
+
+
+def test_list_scrimmages_streamed(client):
+    batch_size = app.config['STREAM_BATCH_SIZE']
+    app.config['STREAM_BATCH_SIZE'] = 2
+    token = login_client_helper(client, 'admin', 'admin')
+
+    for _ in range(5):
+        rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                              'schedule': '2019-04-23T18:25:43.511Z',
+                                              'scrimmage_type': 'Demo',
+                                              'presenters': [2],
+                                              'max_advisors': 1},
+                         headers=token)
+        assert '200' in rv.status
+
+    try:
+        rv = client.get('/Scrimmages', query_string={'all': True,
+                                                     'stream': True},
+                        headers=token)
+        assert '200' in rv.status
+        assert rv.is_streamed
+        data = json.loads(rv.get_data(as_text=True))
+        assert [d['id'] for d in data] == [1, 2, 3, 4, 5]
+        assert all(d['presenters'] == [2] for d in data)
+
+        headers = dict(token, Accept='application/x-ndjson')
+        rv = client.get('/Scrimmages', query_string={'all': True, 'after': 2},
+                        headers=headers)
+        assert rv.mimetype == 'application/x-ndjson'
+        lines = rv.get_data(as_text=True).splitlines()
+        assert [json.loads(line)['id'] for line in lines] == [3, 4, 5]
+    finally:
+        app.config['STREAM_BATCH_SIZE'] = batch_size
+
+
+def test_list_users_streamed(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    rv = client.get('/Users', query_string={'stream': True}, headers=token)
+    assert '200' in rv.status
+    data = json.loads(rv.get_data(as_text=True))
+    assert [d['id'] for d in data] == [1, 2, 3]
+    assert all('password' not in d for d in data)
+
+    rv = client.get('/Users', query_string={'stream': True, 'role': 'nobody'},
+                    headers=token)
+    assert json.loads(rv.get_data(as_text=True)) == []
+
+
+def test_json_backends_match():
+    import datetime
+    from SSAPI.json_backend import OrjsonBackend, StdlibBackend
+    pytest.importorskip('orjson')
+
+    payload = [{'id': 1, 'accepted': None, 'zeta': 'z', 'alpha': [1, 2],
+                'last_sent': datetime.datetime(2019, 4, 23, 18, 25, 43),
+                'responded': datetime.date(2019, 4, 24)}]
+    with app.app_context():
+        expected = StdlibBackend().dumps(payload)
+        assert OrjsonBackend().dumps(payload) == expected
+        assert 'Tue, 23 Apr 2019 18:25:43 GMT' in expected
+
+        # Indented output only differs in whitespace
+        assert (json.loads(OrjsonBackend().dumps(payload, pretty=True)) ==
+                json.loads(StdlibBackend().dumps(payload, pretty=True)))
+
+
+def test_unknown_json_backend():
+    from SSAPI.json_backend import load_backend
+
+    assert load_backend('json').name == 'json'
+    with pytest.raises(ValueError):
+        load_backend('yaml')
+
+
+def test_scrimmage_conditional_get(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Scrimmages', json={'subject': "Test Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [2],
+                                          'max_advisors': 1},
+                     headers=token)
+    assert '200' in rv.status
+
+    rv = client.get('/Scrimmages/1', headers=token)
+    assert '200' in rv.status
+    etag = rv.headers['ETag']
+    assert not etag.startswith('W/')
+    assert rv.headers['Last-Modified']
+
+    with count_statements() as statements:
+        rv = client.get('/Scrimmages/1',
+                        headers=dict(token, **{'If-None-Match': etag}))
+    assert '304' in rv.status
+    assert rv.headers['ETag'] == etag
+    assert not any('presenters' in s for s in statements)
+
+    # Membership changes alone must produce a new ETag
+    rv = client.post('/Scrimmages/1', json={'advisors': [3]}, headers=token)
+    assert '200' in rv.status
+
+    rv = client.get('/Scrimmages/1',
+                    headers=dict(token, **{'If-None-Match': etag}))
+    assert '200' in rv.status
+    assert rv.headers['ETag'] != etag
+    assert rv.get_json()['advisors'] == [3]
+
+
+def test_user_conditional_get(client):
+    token = login_client_helper(client, 'presenter', 'presenter')
+
+    rv = client.get('/Users/2', headers=token)
+    assert '200' in rv.status
+    etag = rv.headers['ETag']
+    last_modified = rv.headers['Last-Modified']
+
+    rv = client.get('/Users/2',
+                    headers=dict(token, **{'If-Modified-Since': last_modified}))
+    assert '304' in rv.status
+
+    rv = client.post('/Users/2', json={'firstname': 'Changed'}, headers=token)
+    assert '200' in rv.status
+
+    rv = client.get('/Users/2',
+                    headers=dict(token, **{'If-None-Match': etag}))
+    assert '200' in rv.status
+    assert rv.get_json()['firstname'] == 'Changed'
+
+
+def test_add_version_columns(client):
+    from SSAPI.migrations import add_version_columns
+
+    with app.app_context():
+        db.session.execute('DROP TABLE scrimmage')
+        db.session.execute('CREATE TABLE scrimmage (id INTEGER PRIMARY KEY, '
+                           'subject TEXT, schedule TEXT, scrimmage_type TEXT, '
+                           'scrimmage_complete BOOLEAN, max_advisors INTEGER)')
+        db.session.execute("INSERT INTO scrimmage (subject) VALUES ('Old')")
+        db.session.commit()
+
+        assert add_version_columns() == ['starts_at', 'ends_at', 'version',
+                                         'updated_at']
+        assert add_version_columns() == []
+        version = db.session.execute('SELECT version FROM scrimmage').scalar()
+        assert version == 1
+
+
+def test_sqlite_pragmas_applied(client):
+    from sqlalchemy.pool import QueuePool
+
+    with app.app_context():
+        assert isinstance(db.engine.pool, QueuePool)
+        with db.engine.connect() as conn:
+            assert conn.execute('PRAGMA journal_mode').scalar() == 'wal'
+            assert conn.execute('PRAGMA synchronous').scalar() == 1
+            assert conn.execute('PRAGMA busy_timeout').scalar() == \
+                app.config['SQLITE_PRAGMAS']['busy_timeout']
+
+
+def test_engine_options():
+    from SSAPI.database import engine_options
+
+    options = engine_options(app.config, 'postgresql://db/ssapi')
+    assert options['pool_size'] == app.config['DB_POOL_SIZE']
+    assert options['max_overflow'] == app.config['DB_MAX_OVERFLOW']
+    assert options['pool_pre_ping'] is True
+    assert 'poolclass' not in options
+
+    assert engine_options(app.config, 'sqlite://') == {}
+
+
+@pytest.fixture
+def replica(client):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    uri = 'sqlite:///' + path
+    with app.app_context():
+        engine = db.get_replica_engine(app, uri)
+        db.Model.metadata.create_all(engine)
+        # Seed the replica with the primary's users so tokens resolve
+        users = [dict(row) for row in
+                 db.engine.execute(User.__table__.select())]
+        engine.execute(User.__table__.insert(), users)
+    app.config['SQLALCHEMY_REPLICA_URIS'] = [uri]
+    yield engine
+    app.config['SQLALCHEMY_REPLICA_URIS'] = []
+    engine.dispose()
+    os.unlink(path)
+
+
+def test_get_routed_to_replica(client, replica):
+    from SSAPI.models import Scrimmage, presenters
+
+    replica.execute(Scrimmage.__table__.insert(),
+                    {'id': 1, 'subject': 'Replica Scrimmage',
+                     'scrimmage_complete': False, 'max_advisors': 1})
+    replica.execute(presenters.insert(), {'user_id': 2, 'scrimmage_id': 1})
+
+    token = login_client_helper(client, 'presenter', 'presenter')
+    rv = client.get('/Scrimmages', headers=token)
+    assert [d['subject'] for d in rv.get_json()] == ['Replica Scrimmage']
+    rv = client.get('/Scrimmages/1', headers=token)
+    assert rv.get_json()['subject'] == 'Replica Scrimmage'
+
+    # Writes go to the primary, and the writer then reads its own writes
+    rv = client.post('/Scrimmages', json={'subject': "Primary Scrimmage",
+                                          'schedule': '2019-04-23T18:25:43.511Z',
+                                          'scrimmage_type': 'Demo',
+                                          'presenters': [2],
+                                          'max_advisors': 1},
+                     headers=token)
+    assert '200' in rv.status
+    rv = client.get('/Scrimmages', headers=token)
+    assert [d['subject'] for d in rv.get_json()] == ['Primary Scrimmage']
+
+    # Other users are still served by the replica
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.get('/Scrimmages', query_string={'all': True}, headers=token)
+    assert [d['subject'] for d in rv.get_json()] == ['Replica Scrimmage']
+
+
+def test_replicas_round_robin(client, replica):
+    uris = ['sqlite:////tmp/replica_a.db', 'sqlite:////tmp/replica_b.db']
+    app.config['SQLALCHEMY_REPLICA_URIS'] = uris
+    with app.app_context():
+        chosen = [str(db.choose_replica(app).url) for _ in range(4)]
+    assert set(chosen) == set(uris)
+    assert chosen[0] == chosen[2] and chosen[1] == chosen[3]
+
+
+def test_core_insert_starts_read_your_writes(client, replica,
+                                             invite_scheduler):
+    token = login_client_helper(client, 'presenter', 'presenter')
+    scrimmage_id = create_scrimmage_helper(client, token, [2])
+
+    # create_invites writes with a bulk table insert, not a flush. The
+    # read comes from a client without cookies, as if another worker
+    # served it, sending back only the header.
+    rv = client.post('/Invites', headers=token,
+                     json={'scrimmage_id': scrimmage_id, 'advisors': [3]})
+    assert '201' in rv.status
+    window = rv.headers['X-Primary-Until']
+    other = app.test_client(use_cookies=False)
+    rv = other.get('/Invites', headers=dict(token, **{
+        'X-Primary-Until': window}))
+    assert [i['advisor_id'] for i in rv.get_json()] == [3]
+    rv = other.get('/Invites', headers=token)
+    assert rv.get_json() == []
+
+
+def test_read_your_writes_window_checked(client, replica):
+    from SSAPI.database import primary_until_signer
+
+    token = login_client_helper(client, 'presenter', 'presenter')
+    create_scrimmage_helper(client, token, [2])
+    client.cookie_jar.clear()
+
+    def subjects(window):
+        other = app.test_client(use_cookies=False)
+        rv = other.get('/Scrimmages', headers=dict(token, **{
+            'X-Primary-Until': window}))
+        return [d['subject'] for d in rv.get_json()]
+
+    def sign(value):
+        return primary_until_signer(app).sign(value).decode()
+
+    import time
+    later = int(time.time()) + 60
+    assert subjects(sign('2:%d' % later)) == ['Test']
+    # Another user's, expired, unsigned or garbled windows are ignored
+    assert subjects(sign('3:%d' % later)) == []
+    assert subjects(sign('2:%d' % (later - 120))) == []
+    assert subjects('2:%d' % later) == []
+    assert subjects(sign('nonsense')) == []
+
+
+def test_change_user_single_update(client):
+    token = login_client_helper(client, 'presenter', 'presenter')
+
+    with count_statements() as statements:
+        rv = client.post('/Users/2', json={'username': 'presenter',
+                                           'firstname': 'Pat',
+                                           'lastname': 'Presenter',
+                                           'password': 'newpass'},
+                         headers=token)
+    assert '200' in rv.status
+    data = rv.get_json()
+    assert data['firstname'] == 'Pat'
+    assert data['version'] == 2
+    updates = [s for s in statements if s.startswith('UPDATE user ')]
+    assert len(updates) == 1
+    # Username unchanged, so no uniqueness query
+    assert not any('user.username = ?' in s for s in statements)
+
+
+def test_change_user_admin_fields(client):
+    token = login_client_helper(client, 'advisor', 'advisor')
+    for change in ({'roles': 'admin,advisor'}, {'is_active': False}):
+        rv = client.post('/Users/3', json=change, headers=token)
+        assert '401' in rv.status
+
+    rv = client.get('/Users/3', headers=token)
+    assert rv.get_json()['roles'] == 'advisor'
+    assert rv.get_json()['version'] == 1
+
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Users/3', json={'roles': 'advisor,presenter'},
+                     headers=token)
+    assert '200' in rv.status
+    assert rv.get_json()['roles'] == 'advisor,presenter'
+
+
+def test_change_user_unknown_field(client):
+    token = login_client_helper(client, 'presenter', 'presenter')
+    rv = client.post('/Users/2', json={'id': 7, 'firstname': 'Pat'},
+                     headers=token)
+
+    assert '400' in rv.status
+    assert 'id' in rv.get_json()['message']
+
+    rv = client.get('/Users/2', headers=token)
+    assert rv.get_json()['firstname'] == 'presenter'
+
+
+def test_import_users_json(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    rows = [{'username': 'cohort%d' % i, 'password': 'pass%d' % i,
+             'firstname': 'Cohort', 'lastname': str(i), 'roles': 'presenter'}
+            for i in range(4)]
+    rows += [{'username': 'advisor', 'password': 'x', 'roles': 'advisor'},
+             {'username': 'cohort0', 'password': 'x', 'roles': 'advisor'},
+             {'username': 'boss', 'password': 'x', 'roles': 'admin'},
+             {'username': 'nopass', 'roles': 'advisor'}]
+
+    with count_statements() as statements:
+        rv = client.post('/Users/Import', json=rows, headers=token)
+    assert '200' in rv.status
+    results = rv.get_json()
+    assert [r['status'] for r in results] == [201] * 4 + [409, 409, 412, 400]
+    assert [r['id'] for r in results[:4]] == [4, 5, 6, 7]
+    inserts = [s for s in statements if s.startswith('INSERT INTO user ')]
+    assert len(inserts) == 1
+
+    rv = client.post('/login', json={'username': 'cohort3',
+                                     'password': 'pass3'})
+    assert '200' in rv.status
+
+    rv = client.get('/Users', query_string={'role': 'presenter'},
+                    headers=token)
+    assert [d['id'] for d in rv.get_json()] == [1, 2, 4, 5, 6, 7]
+
+
+def test_import_users_rejects_non_text(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    rows = [{'username': 'listroles', 'password': 'x', 'roles': ['advisor']},
+            {'username': 5, 'password': 'x', 'roles': 'advisor'},
+            {'username': 'nums', 'password': 'x', 'firstname': 1},
+            {'username': 'fine', 'password': 'x', 'roles': 'advisor'}]
+
+    rv = client.post('/Users/Import', json=rows, headers=token)
+    assert '200' in rv.status
+    results = rv.get_json()
+    assert [r['status'] for r in results] == [400, 400, 400, 201]
+    assert 'roles' in results[0]['message']
+    assert 'username' in results[1]['message']
+    assert 'firstname' in results[2]['message']
+
+
+def test_import_users_csv(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    body = ('username,password,firstname,lastname,roles\n'
+            'csv1,pass1,Csv,One,advisor\n'
+            'csv2,pass2,Csv,Two,"presenter,advisor"\n')
+
+    rv = client.post('/Users/Import', headers=token, data={
+        'file': (io.BytesIO(body.encode()), 'cohort.csv')})
+    assert '200' in rv.status
+    assert [r['status'] for r in rv.get_json()] == [201, 201]
+
+    rv = client.get('/Users/5', headers=token)
+    assert rv.get_json()['roles'] == 'presenter,advisor'
+
+
+def test_import_users_notadmin(client):
+    token = login_client_helper(client, 'presenter', 'presenter')
+    rv = client.post('/Users/Import', json=[], headers=token)
+
+    assert '401' in rv.status
+
+
+def test_login_hash_queue_full(client):
+    from SSAPI import hasher
+    from SSAPI.hashing import HashQueueFull
+
+    if not hasher.workers:
+        pytest.skip("password hashing runs inline")
+    for _ in range(hasher.capacity):
+        assert hasher._slots.acquire(blocking=False)
+    try:
+        rv = client.post('/login', json={'username': 'admin',
+                                         'password': 'admin'})
+        assert '503' in rv.status
+        assert rv.headers['Retry-After'] == str(hasher.retry_after)
+        assert rv.get_json() == {'message': HashQueueFull.description}
+
+        rv = client.post('/Users', json={'username': 'newuser',
+                                         'password': 'newpass',
+                                         'roles': 'presenter'})
+        assert '503' in rv.status
+    finally:
+        for _ in range(hasher.capacity):
+            hasher._slots.release()
+
+    rv = client.post('/login', json={'username': 'admin', 'password': 'admin'})
+    assert '200' in rv.status
+    assert hasher.pending == 0
+
+
+def test_hash_many_takes_slots(client, monkeypatch):
+    from SSAPI import hasher
+    from SSAPI.hashing import HashQueueFull
+
+    if not hasher.workers:
+        pytest.skip("password hashing runs inline")
+    pending = []
+    map_hashes = hasher.executor.map
+
+    def counting_map(func, chunk):
+        pending.append(hasher.pending)
+        return map_hashes(func, chunk)
+
+    monkeypatch.setattr(hasher.executor, 'map', counting_map)
+    hashes = hasher.hash_many(['pw%d' % i for i in range(5)])
+    assert len(hashes) == 5
+    assert 0 < max(pending) <= hasher.workers
+    assert hasher.pending == 0
+    with app.app_context():
+        assert guard._verify_password('pw4', hashes[4])
+
+    token = login_client_helper(client, 'admin', 'admin')
+    monkeypatch.setattr(hasher, 'retry_after', 0.01)
+    for _ in range(hasher.capacity):
+        assert hasher._slots.acquire(blocking=False)
+    try:
+        with pytest.raises(HashQueueFull):
+            hasher.hash_many(['a', 'b'])
+        rv = client.post('/Users/Import', headers=token, json=[
+            {'username': 'u%d' % i, 'password': 'x'} for i in range(3)])
+        assert '503' in rv.status
+    finally:
+        for _ in range(hasher.capacity):
+            hasher._slots.release()
+    assert hasher.pending == 0
+
+
+def test_hash_pool_replaced_after_worker_dies(client):
+    import signal
+    import time
+    from SSAPI import hasher
+
+    if not hasher.workers:
+        pytest.skip("password hashing runs inline")
+    login_client_helper(client, 'admin', 'admin')
+    broken = hasher.executor
+    for pid in list(broken._processes):
+        os.kill(pid, signal.SIGKILL)
+    time.sleep(0.2)
+
+    rv = client.post('/login', json={'username': 'admin', 'password': 'admin'})
+    assert '200' in rv.status
+    assert hasher.executor is not broken
+    assert hasher.pending == 0
+
+
+def expired_token_helper(user_id):
+    import pendulum
+
+    with app.app_context():
+        user = User.query.get(user_id)
+        return guard.encode_jwt_token(
+            user, override_access_lifespan=pendulum.duration(seconds=-10))
+
+
+def test_refresh_token(client):
+    token = expired_token_helper(2)
+
+    rv = client.get('/Scrimmages', headers={'Authorization': 'Bearer ' + token})
+    assert '401' in rv.status
+
+    rv = client.post('/refresh', headers={'Authorization': 'Bearer ' + token})
+    assert '200' in rv.status
+    new_token = rv.get_json()['access_token']
+    assert decode_jwt(new_token)['id'] == 2
+    assert decode_jwt(new_token)['rf_exp'] == decode_jwt(token)['rf_exp']
+
+    rv = client.get('/Scrimmages',
+                    headers={'Authorization': 'Bearer ' + new_token})
+    assert '200' in rv.status
+
+
+def test_refresh_token_not_expired(client):
+    token = login_client_helper(client, 'presenter', 'presenter')
+    rv = client.post('/refresh', headers=token)
+
+    assert '401' in rv.status
+
+
+def test_refresh_token_missing(client):
+    rv = client.post('/refresh')
+
+    assert '401' in rv.status
+
+
+def test_request_instrumentation(client, monkeypatch, caplog):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    rv = client.get('/Users', headers=token)
+    assert 'Server-Timing' not in rv.headers
+
+    monkeypatch.setitem(app.config, 'INSTRUMENTATION', True)
+    with caplog.at_level('INFO', logger='SSAPI.instrumentation'):
+        rv = client.get('/Users', headers=token)
+
+    assert '200' in rv.status
+    timing = rv.headers['Server-Timing']
+    assert timing.startswith('db;dur=')
+    assert 'serialize;dur=' in timing and 'total;dur=' in timing
+
+    line = json.loads(caplog.records[-1].getMessage())
+    assert line['route'] == '/Users'
+    assert line['status'] == 200
+    assert line['sql_count'] >= 1
+    assert line['json_bytes'] == len(rv.data)
+    assert '"%d queries"' % line['sql_count'] in timing
+
+
+def metric_value(body, name):
+    for line in body.splitlines():
+        if line.startswith(name + ' '):
+            return float(line.rsplit(' ', 1)[1])
+    return None
+
+
+def test_metrics_endpoint(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    client.get('/Users', headers=token)
+    client.get('/Users', headers=token)
+    client.get('/nowhere')
+
+    rv = client.get('/metrics')
+    assert '200' in rv.status
+    assert rv.content_type.startswith('text/plain')
+    body = rv.get_data(as_text=True)
+
+    users = '{route="/Users",method="GET"'
+    assert metric_value(body, 'ssapi_requests_total%s,code="200"}'
+                        % users) >= 2
+    assert metric_value(body, 'ssapi_request_duration_seconds_count%s}'
+                        % users) >= 2
+    assert metric_value(body, 'ssapi_request_duration_seconds_bucket%s,'
+                              'le="+Inf"}' % users) >= 2
+    assert metric_value(body, 'ssapi_requests_total{route="/login",'
+                              'method="POST",code="200"}') >= 1
+    assert metric_value(body, 'ssapi_requests_total{route="<unmatched>",'
+                              'method="GET",code="404"}') >= 1
+    assert metric_value(body, 'ssapi_db_pool_checkouts_total') > 0
+    assert metric_value(body, 'ssapi_password_hash_pending') == 0
+
+
+def test_metrics_aggregate_processes(client, tmp_path, monkeypatch):
+    from SSAPI.metrics import BUCKETS, registry
+
+    monkeypatch.setattr(registry, 'directory', str(tmp_path))
+    other = {'requests': [['/Users', 'GET', 500, 3]],
+             'latency': [['/Users', 'GET', [0] * 11 + [3, 1.5]]],
+             'checkouts': 7, 'checkins': 5,
+             'gauges': {'password_hash_pending': 4}}
+    with open(registry.path(os.getppid()), 'w') as f:
+        json.dump(other, f)
+    # A worker that has exited: counters stay, its gauges are dropped
+    with open(registry.path(2 ** 22 + 1), 'w') as f:
+        json.dump(dict(other, gauges={'password_hash_pending': 100}), f)
+
+    local = registry.totals()['latency'].get(('/Users', 'GET'),
+                                              [0] * (len(BUCKETS) + 2))
+    body = client.get('/metrics').get_data(as_text=True)
+    assert os.path.exists(registry.path(os.getpid()))
+    assert metric_value(body, 'ssapi_request_errors_total'
+                              '{route="/Users",method="GET"}') == 6
+    # Both files' requests land in the +Inf bucket only
+    users = '{route="/Users",method="GET"'
+    assert metric_value(body, 'ssapi_request_duration_seconds_bucket%s,'
+                              'le="10.0"}' % users) == sum(local[:-2])
+    assert metric_value(body, 'ssapi_request_duration_seconds_bucket%s,'
+                              'le="+Inf"}' % users) == sum(local[:-1]) + 6
+    assert metric_value(body, 'ssapi_request_duration_seconds_count%s}'
+                        % users) == sum(local[:-1]) + 6
+    assert metric_value(body, 'ssapi_request_duration_seconds_sum%s}'
+                        % users) == pytest.approx(local[-1] + 3.0)
+    assert metric_value(body, 'ssapi_password_hash_pending') == 4
+    assert metric_value(body, 'ssapi_db_pool_checked_out') >= 2
+
+
+def test_metrics_retire_finished_threads():
+    import threading
+    from SSAPI.metrics import PRUNE_MIN_SHARDS, Registry
+
+    registry = Registry()
+    for _ in range(1000):
+        thread = threading.Thread(target=registry.observe_request,
+                                  args=('/', 'GET', 200, 0.001))
+        thread.start()
+        thread.join()
+    assert len(registry._shards) <= PRUNE_MIN_SHARDS
+    total = registry.totals()
+    assert total['requests'] == {('/', 'GET', 200): 1000}
+    assert registry._shards == []
+
+
+def test_slow_query_log(client, monkeypatch, caplog):
+    from SSAPI.slow_queries import slow_query_log
+
+    token = login_client_helper(client, 'presenter', 'presenter')
+    monkeypatch.setattr(slow_query_log, 'threshold', 0)
+    with caplog.at_level('WARNING', logger='SSAPI.slow_queries'):
+        rv = client.get('/Scrimmages', headers=token)
+    assert '200' in rv.status
+
+    logged = [json.loads(record.getMessage()) for record in caplog.records
+              if record.name == 'SSAPI.slow_queries']
+    listing = [entry for entry in logged
+               if entry['statement'].lstrip().startswith('SELECT') and
+               'FROM scrimmage' in entry['statement']]
+    assert listing
+    entry = listing[0]
+    assert entry['view'] == 'ScrimmageList.get'
+    assert entry['parameters'] == ['int', 'int']
+    assert entry['plan'] and not entry['plan'][0].startswith('EXPLAIN')
+
+
+def test_slow_query_log_threshold(client, monkeypatch, caplog):
+    from SSAPI.slow_queries import slow_query_log
+
+    token = login_client_helper(client, 'presenter', 'presenter')
+    monkeypatch.setattr(slow_query_log, 'threshold', 60)
+    with caplog.at_level('WARNING', logger='SSAPI.slow_queries'):
+        client.get('/Scrimmages', headers=token)
+    assert not [r for r in caplog.records if r.name == 'SSAPI.slow_queries']
+
+
+def query_plan(query):
+    sql = str(query.statement.compile(db.engine,
+                                      compile_kwargs={'literal_binds': True}))
+    rows = db.session.execute('EXPLAIN QUERY PLAN ' + sql)
+    return ' '.join(row[-1] for row in rows)
+
+
+def test_association_and_invite_indexes_used(client):
+    from SSAPI.models import ScrimmageInvite, advisors, presenters
+
+    with app.app_context():
+        for table in (advisors, presenters):
+            plan = query_plan(db.session.query(table.c.user_id).filter(
+                table.c.scrimmage_id.in_([1, 2])))
+            assert 'ix_%s_scrimmage_user' % table.name in plan
+
+            plan = query_plan(db.session.query(table.c.scrimmage_id).filter(
+                table.c.user_id == 1))
+            assert 'sqlite_autoindex_%s_1' % table.name in plan
+
+        plan = query_plan(ScrimmageInvite.query.filter_by(scrimmage_id=1))
+        assert 'ix_scrimmage_invite_scrimmage_id' in plan
+        plan = query_plan(ScrimmageInvite.query.filter_by(advisor_id=1))
+        assert 'ix_scrimmage_invite_advisor_id' in plan
+
+
+def test_upgrade_adds_indexes(client):
+    from SSAPI.migrations import upgrade
+
+    indexes = ['ix_advisors_scrimmage_user', 'ix_presenters_scrimmage_user',
+               'ix_scrimmage_invite_advisor_id',
+               'ix_scrimmage_invite_last_sent',
+               'ix_scrimmage_invite_scrimmage_id']
+    with app.app_context():
+        for name in indexes:
+            db.session.execute('DROP INDEX %s' % name)
+        db.session.commit()
+
+        assert sorted(upgrade()['indexes']) == indexes
+        assert upgrade() == {'columns': [], 'roles': 5, 'indexes': [],
+                             'schedules': 0, 'search': 0}
+
+
+def test_member_filter_starts_from_user(client):
+    from SSAPI.models import Scrimmage, scrimmage_serializer
+
+    with app.app_context():
+        members = Scrimmage.member_ids(2).alias('members')
+        plan = query_plan(scrimmage_serializer.query().join(
+            members, members.c.scrimmage_id == Scrimmage.id))
+    assert 'SCAN scrimmage' not in plan
+    assert 'sqlite_autoindex_advisors_1 (user_id=?)' in plan
+    assert 'sqlite_autoindex_presenters_1 (user_id=?)' in plan
+    assert 'SEARCH scrimmage USING INTEGER PRIMARY KEY' in plan
+
+
+def test_list_scrimmages_both_roles(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    for presenters, advisor in (([1], True), ([1], False), ([2], True)):
+        rv = client.post('/Scrimmages', headers=token,
+                         json={'subject': 'Test', 'schedule': 'Now',
+                               'scrimmage_type': 'Test',
+                               'presenters': presenters})
+        if advisor:
+            client.post('/Scrimmages/%d' % rv.get_json()['id'],
+                        headers=token, json={'advisors': [1]})
+
+    rv = client.get('/Scrimmages?role=presenter,advisor', headers=token)
+    assert [s['id'] for s in rv.get_json()] == [1]
+
+    rv = client.get('/Scrimmages?all=true&role=advisor', headers=token)
+    assert [s['id'] for s in rv.get_json()] == [1, 3]
+
+    rv = client.get('/Scrimmages', headers=token)
+    assert [s['id'] for s in rv.get_json()] == [1, 2, 3]
+
+
+@pytest.fixture
+def invite_scheduler(client, monkeypatch):
+    from SSAPI.invites import MemoryDelivery, ResendScheduler
+
+    scheduler = ResendScheduler(MemoryDelivery(), 3600, 1)
+    monkeypatch.setitem(app.extensions, 'invite_scheduler', scheduler)
+    return scheduler
+
+
+def create_scrimmage_helper(client, token, presenters):
+    rv = client.post('/Scrimmages', headers=token,
+                     json={'subject': 'Test', 'schedule': 'Now',
+                           'scrimmage_type': 'Test',
+                           'presenters': presenters})
+    return rv.get_json()['id']
+
+
+def test_create_invites(client, invite_scheduler):
+    token = login_client_helper(client, 'presenter', 'presenter')
+    scrimmage_id = create_scrimmage_helper(client, token, [2])
+
+    with count_statements() as statements:
+        rv = client.post('/Invites', headers=token,
+                         json={'scrimmage_id': scrimmage_id,
+                               'advisors': [3, 1, 3]})
+    assert '201' in rv.status
+    assert [i['advisor_id'] for i in rv.get_json()] == [3, 1]
+    assert len([s for s in statements if s.startswith('INSERT')]) == 1
+    # Its thread is not running here, so nothing is queued in-process
+    assert len(invite_scheduler) == 0
+
+    rv = client.get('/Scrimmages/%d' % scrimmage_id, headers=token)
+    assert rv.get_json()['invites'] == [1, 2]
+    assert rv.get_json()['version'] == 2
+    etag = rv.headers['ETag']
+
+    rv = client.post('/Invites', headers=token,
+                     json={'scrimmage_id': scrimmage_id, 'advisors': [1]})
+    assert '201' in rv.status
+    assert rv.get_json() == []
+    rv = client.get('/Scrimmages/%d' % scrimmage_id,
+                    headers=dict(token, **{'If-None-Match': etag}))
+    assert '304' in rv.status
+
+    rv = client.post('/Invites', headers=token,
+                     json={'scrimmage_id': scrimmage_id, 'advisors': [2]})
+    assert '400' in rv.status
+
+    token = login_client_helper(client, 'advisor', 'advisor')
+    rv = client.post('/Invites', headers=token,
+                     json={'scrimmage_id': scrimmage_id, 'advisors': [3]})
+    assert '401' in rv.status
+
+
+def test_list_invites(client, invite_scheduler):
+    token = login_client_helper(client, 'admin', 'admin')
+    mine = create_scrimmage_helper(client, token, [2])
+    other = create_scrimmage_helper(client, token, [1])
+    client.post('/Invites', headers=token,
+                json={'scrimmage_id': mine, 'advisors': [1, 3]})
+    client.post('/Invites', headers=token,
+                json={'scrimmage_id': other, 'advisors': [1]})
+
+    token = login_client_helper(client, 'presenter', 'presenter')
+    rv = client.get('/Invites', headers=token)
+    assert [i['id'] for i in rv.get_json()] == [1, 2]
+
+    token = login_client_helper(client, 'advisor', 'advisor')
+    rv = client.get('/Invites', headers=token)
+    assert [i['id'] for i in rv.get_json()] == [2]
+
+    rv = client.post('/Invites/2', headers=token, json={'accepted': True})
+    assert '200' in rv.status
+    assert rv.get_json()['accepted'] is True
+    rv = client.get('/Scrimmages/%d' % mine, headers=token)
+    assert rv.get_json()['advisors'] == [3]
+    rv = client.get('/Invites?pending=true', headers=token)
+    assert rv.get_json() == []
+
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.get('/Invites?pending=true&limit=1', headers=token)
+    assert [i['id'] for i in rv.get_json()] == [1]
+    assert rv.headers['X-Next-Cursor'] == '1'
+    rv = client.post('/Invites/2', headers=token, json={'accepted': False})
+    assert '401' in rv.status
+
+
+def test_invite_resend_scheduler(client, invite_scheduler):
+    import datetime
+    from SSAPI.models import ScrimmageInvite
+
+    token = login_client_helper(client, 'admin', 'admin')
+    scrimmage_id = create_scrimmage_helper(client, token, [2])
+    client.post('/Invites', headers=token,
+                json={'scrimmage_id': scrimmage_id, 'advisors': [1, 3]})
+    sent = invite_scheduler.delivery.sent
+    now = datetime.datetime.utcnow()
+
+    with app.app_context(), count_statements() as statements:
+        assert invite_scheduler.tick(now) == 2
+    # One poll for unsent invites, then one batch per invite (batch_size
+    # is 1), each loaded by id
+    selects = [s for s in statements if s.startswith('SELECT')]
+    assert len(selects) == 3
+    assert 'scrimmage_invite.last_sent IS NULL' in selects[0]
+    assert all('scrimmage_invite.id IN' in s for s in selects[1:])
+    assert [m['advisor_id'] for m in sent] == [1, 3]
+    assert sent[0]['subject'] == 'Test'
+
+    with app.app_context():
+        assert invite_scheduler.tick(now) == 0
+        assert ScrimmageInvite.query.get(1).last_sent == now
+
+    token = login_client_helper(client, 'advisor', 'advisor')
+    client.post('/Invites/2', headers=token, json={'accepted': False})
+
+    later = now + invite_scheduler.interval
+    with app.app_context():
+        assert invite_scheduler.tick(later) == 1
+    assert sent[-1]['invite_id'] == 1
+    assert len(invite_scheduler) == 1
+
+
+def test_invite_scheduler_load_and_file_delivery(client, tmp_path):
+    import datetime
+    from SSAPI.invites import (FileDelivery, ResendScheduler, create_invites,
+                               load_delivery)
+    from SSAPI.models import Scrimmage, ScrimmageInvite
+
+    now = datetime.datetime.utcnow()
+    path = str(tmp_path / 'invites.jsonl')
+    scheduler = ResendScheduler(load_delivery('file:' + path), 60, 100,
+                                clock=lambda: now)
+    assert isinstance(scheduler.delivery, FileDelivery)
+    with pytest.raises(ValueError):
+        load_delivery('smtp')
+
+    with app.app_context():
+        db.session.add(Scrimmage(subject='Loaded', max_advisors=5))
+        db.session.flush()
+        create_invites(1, [1, 3])
+        ScrimmageInvite.query.filter_by(advisor_id=3).update(
+            {'last_sent': now})
+        db.session.commit()
+
+        scheduler.load()
+        assert scheduler.next_due() == now
+        assert scheduler.tick() == 1
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert [line['advisor_id'] for line in lines] == [1]
+    assert scheduler.next_due() == now + scheduler.interval
+
+
+def test_invite_scheduler_polls_new_invites(client):
+    import datetime
+    import time
+    from SSAPI.invites import MemoryDelivery, ResendScheduler, create_invites
+    from SSAPI.models import Scrimmage, ScrimmageInvite
+
+    now = datetime.datetime.utcnow()
+    scheduler = ResendScheduler(MemoryDelivery(), 3600, 100, 0.05,
+                                clock=lambda: now)
+    with app.app_context():
+        db.session.add(Scrimmage(subject='Polled', max_advisors=5))
+        db.session.commit()
+        scheduler.load()
+        # As if another worker created it after this one loaded
+        create_invites(1, [3])
+        db.session.commit()
+        assert scheduler.tick() == 1
+        assert scheduler.tick() == 0
+        plan = query_plan(db.session.query(ScrimmageInvite.id).filter(
+            ScrimmageInvite.last_sent.is_(None)))
+        assert 'ix_scrimmage_invite_last_sent' in plan
+
+    scheduler.wake()
+    assert len(scheduler) == 1 and not scheduler.running
+
+    scheduler.start(app)
+    try:
+        with app.app_context():
+            create_invites(1, [1])
+            db.session.commit()
+        scheduler.wake()
+        for _ in range(100):
+            if len(scheduler.delivery.sent) == 2:
+                break
+            time.sleep(0.02)
+    finally:
+        scheduler.stop()
+    assert [m['advisor_id'] for m in scheduler.delivery.sent] == [3, 1]
+
+
+def test_matching_augments_greedy_choice():
+    from SSAPI.assignment import Matching
+
+    matching = Matching({1: 1, 2: 1}, {10: 1, 20: 1})
+    # Greedy gives advisor 1 scrimmage 10, leaving advisor 2 nothing; the
+    # augmenting path moves advisor 1 to 20 instead
+    matching.add_pairs([1, 1, 2], [10, 20, 10], [5.0, 1.0, 3.0])
+    assert matching.pairs() == [(10, 1)]
+    matching.maximize()
+    assert matching.pairs() == [(10, 2), (20, 1)]
+    assert matching.seats == {10: 0, 20: 0}
+    assert matching.capacity == {1: 0, 2: 0}
+
+
+def test_score_pairs():
+    from SSAPI import assignment
+
+    scores = assignment.score_pairs(
+        [1, 2, 2], [10, 10, 20],
+        [assignment.ACCEPTED, assignment.PENDING, assignment.FILL],
+        {2: 1}, {10: 0.5, 20: 0.0})
+    assert scores == pytest.approx([4.5, 2.0, 1.5])
+
+
+def test_assign_advisors(client, invite_scheduler):
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Scrimmages', headers=token,
+                     json={'subject': 'Test', 'schedule': 'Now',
+                           'scrimmage_type': 'Test', 'presenters': [2],
+                           'max_advisors': 1})
+    scrimmage_id = rv.get_json()['id']
+    client.post('/Invites', headers=token,
+                json={'scrimmage_id': scrimmage_id, 'advisors': [1, 3]})
+    # A declined invite is never assigned
+    client.post('/Invites/1', headers=token, json={'accepted': False})
+    advisor = login_client_helper(client, 'advisor', 'advisor')
+
+    rv = client.post('/Scrimmages/Assign', headers=advisor)
+    assert '401' in rv.status
+
+    rv = client.post('/Scrimmages/Assign?dry_run=true', headers=token)
+    ret = rv.get_json()
+    assert ret['dry_run'] is True
+    assert [(a['advisor_id'], a['source']) for a in ret['assignments']] == \
+        [(3, 'pending')]
+    assert ret['open_seats'] == 0
+    rv = client.get('/Scrimmages/%d' % scrimmage_id, headers=token)
+    assert rv.get_json()['advisors'] == []
+
+    rv = client.post('/Scrimmages/Assign', headers=token)
+    assert rv.get_json()['dry_run'] is False
+    assert rv.get_json()['skipped'] == []
+    rv = client.get('/Scrimmages/%d' % scrimmage_id, headers=token)
+    assert rv.get_json()['advisors'] == [3]
+    # Bumped once by the invites and once by the assignment
+    assert rv.get_json()['version'] == 3
+
+    rv = client.post('/Scrimmages/Assign', headers=token)
+    assert rv.get_json()['assignments'] == []
+
+
+def test_assign_advisors_rechecks_seats(client):
+    from SSAPI import assignment
+    from SSAPI.models import Scrimmage
+
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Scrimmages', headers=token,
+                     json={'subject': 'Test', 'schedule': 'Now',
+                           'scrimmage_type': 'Test', 'presenters': [2],
+                           'max_advisors': 1})
+    scrimmage_id = rv.get_json()['id']
+
+    with app.app_context():
+        planned = assignment.solve(1, fill=True)['assignments']
+        assert [a['advisor_id'] for a in planned] == [1]
+        # Another advisor takes the only seat before the plan is applied
+        assert Scrimmage.add_advisor(scrimmage_id, 3)
+        db.session.commit()
+
+        assert assignment.apply(planned + planned) == planned + planned
+        db.session.commit()
+        assert [u.id for u in Scrimmage.query.get(scrimmage_id).advisors] \
+            == [3]
+
+        # A pair applied twice is skipped the second time, not an error
+        db.session.execute('DELETE FROM advisors')
+        db.session.commit()
+        assert assignment.apply(planned + planned) == planned
+        db.session.commit()
+
+
+def test_assign_advisors_fill(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    ids = [create_scrimmage_helper(client, token, presenters)
+           for presenters in ([1], [2])]
+
+    rv = client.post('/Scrimmages/Assign?fill=true&dry_run=true',
+                     headers=token)
+    pairs = [(a['scrimmage_id'], a['advisor_id'], a['source'])
+             for a in rv.get_json()['assignments']]
+    # Admin presents the first scrimmage, so only the second may take them
+    assert pairs == [(ids[0], 3, 'fill'), (ids[1], 1, 'fill')]
+    assert rv.get_json()['unassigned_advisors'] == 0
+
+
+def test_scrimmage_update_version_conflict(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    scrimmage_id = create_scrimmage_helper(client, token, [2])
+
+    rv = client.post('/Scrimmages/%d' % scrimmage_id, headers=token,
+                     json={'subject': 'First', 'version': 1})
+    assert '200' in rv.status
+    assert rv.get_json()['version'] == 2
+
+    rv = client.post('/Scrimmages/%d' % scrimmage_id, headers=token,
+                     json={'subject': 'Second', 'version': 1})
+    assert '409' in rv.status
+    assert rv.get_json()['version'] == 2
+
+    rv = client.get('/Scrimmages/%d' % scrimmage_id, headers=token)
+    assert rv.get_json()['subject'] == 'First'
+
+    # Authorization comes before the version check
+    advisor = login_client_helper(client, 'advisor', 'advisor')
+    rv = client.post('/Scrimmages/%d' % scrimmage_id, headers=advisor,
+                     json={'subject': 'Third', 'version': 99})
+    assert '401' in rv.status
+    assert 'version' not in rv.get_json()
+
+    rv = client.post('/Scrimmages/99', headers=token,
+                     json={'subject': 'Missing', 'version': 1})
+    assert '404' in rv.status
+
+
+def test_scrimmage_join_advisor(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    rv = client.post('/Scrimmages', headers=token,
+                     json={'subject': 'Test', 'schedule': 'Now',
+                           'scrimmage_type': 'Test', 'presenters': [2],
+                           'max_advisors': 1})
+    scrimmage_id = rv.get_json()['id']
+    url = '/Scrimmages/%d/Advisors' % scrimmage_id
+
+    advisor = login_client_helper(client, 'advisor', 'advisor')
+    rv = client.post(url, headers=advisor, json={'advisor_id': 1})
+    assert '401' in rv.status
+    rv = client.post(url, headers=token, json={'advisor_id': 2})
+    assert '400' in rv.status
+    # Advisors may only add themselves where they are invited
+    rv = client.post(url, headers=advisor, json={'advisor_id': 3})
+    assert '401' in rv.status
+
+    client.post('/Invites', headers=token,
+                json={'scrimmage_id': scrimmage_id, 'advisors': [3]})
+    rv = client.post(url, headers=advisor, json={'advisor_id': 3})
+    assert '201' in rv.status
+    assert rv.get_json()['advisors'] == [3]
+    assert rv.get_json()['version'] == 3
+    rv = client.get('/Invites/1', headers=advisor)
+    assert rv.get_json()['accepted'] is True
+
+    rv = client.post(url, headers=advisor, json={'advisor_id': 3})
+    assert '200' in rv.status
+    rv = client.post(url, headers=token, json={'advisor_id': 1})
+    assert '409' in rv.status
+
+    rv = client.post('/Scrimmages/99/Advisors', headers=token,
+                     json={'advisor_id': 1})
+    assert '404' in rv.status
+
+
+@pytest.mark.parametrize('path', ['join', 'accept'])
+def test_scrimmage_join_advisor_concurrent(client, path):
+    import threading
+    from SSAPI.models import Scrimmage, ScrimmageInvite, UserRole
+
+    advisors_count, seats = 24, 5
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {'id': i, 'username': 'advisor%d' % i, 'password': 'x',
+             'roles': 'advisor', 'is_active': True}
+            for i in range(10, 10 + advisors_count)])
+        db.session.execute(UserRole.__table__.insert(), [
+            {'user_id': i, 'name': 'advisor'}
+            for i in range(10, 10 + advisors_count)])
+        db.session.add(Scrimmage(subject='Busy', max_advisors=seats))
+        db.session.execute(ScrimmageInvite.__table__.insert(), [
+            {'id': i, 'scrimmage_id': 1, 'advisor_id': i}
+            for i in range(10, 10 + advisors_count)])
+        db.session.commit()
+        tokens = {i: guard.encode_jwt_token(User.query.get(i))
+                  for i in range(10, 10 + advisors_count)}
+
+    start = threading.Barrier(advisors_count)
+    statuses = []
+
+    def join(user_id):
+        local_client = app.test_client()
+        headers = {'Authorization': 'Bearer ' + tokens[user_id]}
+        start.wait()
+        if path == 'join':
+            rv = local_client.post('/Scrimmages/1/Advisors', headers=headers,
+                                   json={'advisor_id': user_id})
+        else:
+            rv = local_client.post('/Invites/%d' % user_id, headers=headers,
+                                   json={'accepted': True})
+        statuses.append(rv.status_code)
+
+    threads = [threading.Thread(target=join, args=(i,)) for i in tokens]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    joined = 201 if path == 'join' else 200
+    assert sorted(statuses) == \
+        [joined] * seats + [409] * (advisors_count - seats)
+    with app.app_context():
+        scrimmage = Scrimmage.query.get(1)
+        assert len(scrimmage.advisors) == seats
+        assert scrimmage.version == 1 + seats
+        # Only the invites that got a seat are answered
+        answered = ScrimmageInvite.query.filter(
+            ScrimmageInvite.responded.isnot(None)).all()
+        assert sorted(i.advisor_id for i in answered) == \
+            sorted(u.id for u in scrimmage.advisors)
+
+
+def test_parse_schedule():
+    import datetime
+    from SSAPI.schedule import parse_schedule
+
+    start = datetime.datetime(2019, 4, 23, 18, 25, 43, 511000)
+    with app.app_context():
+        assert parse_schedule('2019-04-23T18:25:43.511Z') == \
+            (start, start + datetime.timedelta(minutes=60))
+        assert parse_schedule('2019-04-23T20:25:43.511+02:00/'
+                              '2019-04-23T19:00:00Z') == \
+            (start, datetime.datetime(2019, 4, 23, 19))
+        assert parse_schedule('Tuesday after lunch') == (None, None)
+        assert parse_schedule('2019-04-23T19:00/2019-04-23T18:00') == \
+            (None, None)
+
+
+def test_find_overlaps():
+    from SSAPI.schedule import find_overlaps
+
+    intervals = [(1, 0, 10, 'a'), (1, 5, 15, 'b'), (1, 10, 20, 'c'),
+                 (1, 12, 13, 'd'), (2, 0, 10, 'e'), (2, 10, 11, 'f')]
+    assert sorted(find_overlaps(intervals)) == [
+        (1, 'a', 'b'), (1, 'b', 'c'), (1, 'b', 'd'), (1, 'c', 'd')]
+
+
+def test_list_scrimmages_time_range(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    for schedule in ('2019-04-22T09:00:00Z', '2019-04-24T09:00:00Z',
+                     '2019-05-01T09:00:00Z', 'Someday'):
+        client.post('/Scrimmages', headers=token,
+                    json={'subject': 'Test', 'schedule': schedule,
+                          'scrimmage_type': 'Test', 'presenters': [2]})
+
+    rv = client.get('/Scrimmages?all=true&from=2019-04-22T00:00:00Z'
+                    '&to=2019-04-29T00:00:00Z', headers=token)
+    assert [s['id'] for s in rv.get_json()] == [1, 2]
+    rv = client.get('/Scrimmages?all=true&from=2019-04-23T00:00:00Z',
+                    headers=token)
+    assert [s['id'] for s in rv.get_json()] == [2, 3]
+
+    from SSAPI.models import Scrimmage, scrimmage_serializer
+    with app.app_context():
+        plan = query_plan(scrimmage_serializer.query().filter(
+            Scrimmage.starts_at >= '2019-04-22',
+            Scrimmage.starts_at < '2019-04-29'))
+    assert 'ix_scrimmage_starts_at' in plan
+
+
+def test_scrimmage_schedule_conflicts(client):
+    token = login_client_helper(client, 'admin', 'admin')
+
+    def create(schedule, presenters):
+        rv = client.post('/Scrimmages', headers=token,
+                         json={'subject': 'Test', 'schedule': schedule,
+                               'scrimmage_type': 'Test',
+                               'presenters': presenters})
+        return rv.get_json()
+
+    assert 'conflicts' not in create('2019-04-23T09:00:00Z', [2])
+    assert 'conflicts' not in create('2019-04-23T10:00:00Z', [2])
+    ret = create('2019-04-23T09:30:00Z/2019-04-23T10:30:00Z', [1, 2])
+    assert ret['conflicts'] == [{'user_id': 2, 'scrimmage_id': 1},
+                                {'user_id': 2, 'scrimmage_id': 2}]
+
+    with count_statements() as statements:
+        rv = client.post('/Scrimmages/1/Advisors', headers=token,
+                         json={'advisor_id': 1})
+    assert rv.get_json()['conflicts'] == [{'user_id': 1, 'scrimmage_id': 3}]
+    assert len([s for s in statements if 'UNION' in s]) == 1
+
+    rv = client.post('/Scrimmages/3', headers=token,
+                     json={'schedule': '2019-04-24T09:00:00Z'})
+    assert 'conflicts' not in rv.get_json()
+
+    rv = client.post('/Scrimmages/2', headers=token,
+                     json={'schedule': '2019-04-23T09:30:00Z'})
+    assert rv.get_json()['conflicts'] == [{'user_id': 2, 'scrimmage_id': 1}]
+
+    rv = client.get('/Scrimmages/Conflicts', headers=token)
+    assert rv.get_json() == [{'user_id': 2, 'scrimmages': [1, 2]}]
+    rv = client.get('/Scrimmages/Conflicts?from=2019-04-23T10:30:00Z',
+                    headers=token)
+    assert rv.get_json() == []
+
+
+def test_populate_schedule_times(client):
+    import datetime
+    from SSAPI.migrations import (add_indexes, add_version_columns,
+                                  populate_schedule_times)
+
+    with app.app_context():
+        db.session.execute('DROP TABLE scrimmage')
+        db.session.execute('CREATE TABLE scrimmage (id INTEGER PRIMARY KEY, '
+                           'subject TEXT, schedule TEXT, scrimmage_type TEXT, '
+                           'scrimmage_complete BOOLEAN, max_advisors INTEGER)')
+        db.session.execute("INSERT INTO scrimmage (schedule) VALUES "
+                           "('2019-04-23T18:00:00Z'), ('Next week')")
+        db.session.commit()
+        add_version_columns()
+
+        assert 'ix_scrimmage_starts_at' in add_indexes()
+        assert populate_schedule_times() == 1
+        assert populate_schedule_times() == 0
+        rows = db.session.execute('SELECT starts_at, ends_at FROM scrimmage '
+                                  'ORDER BY id').fetchall()
+    assert rows[0] == ('2019-04-23 18:00:00.000000',
+                       '2019-04-23 19:00:00.000000')
+    assert rows[1] == (None, None)
+
+
+def test_search_scrimmages(client):
+    token = login_client_helper(client, 'admin', 'admin')
+    for subject, scrimmage_type, presenters in (
+            ('Python packaging', 'Demo', [1]),
+            ('Database indexing', 'Talk', [2]),
+            ('Pythonic idioms', 'Demo', [2]),
+            ('Demo day', 'Talk', [1])):
+        client.post('/Scrimmages', headers=token,
+                    json={'subject': subject, 'schedule': 'Now',
+                          'scrimmage_type': scrimmage_type,
+                          'presenters': presenters})
+
+    def search(query, headers=token):
+        rv = client.get('/Scrimmages/Search?' + query, headers=headers)
+        assert '200' in rv.status
+        return [s['id'] for s in rv.get_json()]
+
+    assert search('q=python&all=true') == [1]
+    assert sorted(search('q=pyth&prefix=true&all=true')) == [1, 3]
+    assert sorted(search('q=pyth*&all=true')) == [1, 3]
+    # A subject match outranks a type match
+    assert search('q=demo&all=true') == [4, 1, 3]
+    assert search('q=python%20OR%20"idioms&all=true') == []
+
+    # Same visibility as /Scrimmages
+    assert search('q=demo') == [4, 1]
+    presenter = login_client_helper(client, 'presenter', 'presenter')
+    assert search('q=demo&all=true', presenter) == [3]
+
+    client.post('/Scrimmages/2', headers=token,
+                json={'subject': 'Query planning'})
+    assert search('q=indexing&all=true') == []
+    assert search('q=planning&all=true') == [2]
+
+    client.delete('/Scrimmages/1', headers=token)
+    assert search('q=packaging&all=true') == []
+
+    rv = client.get('/Scrimmages/Search?q=%20*', headers=token)
+    assert '400' in rv.status
+
+
+def test_search_index_follows_orm_changes(client):
+    from SSAPI.models import Scrimmage
+    from SSAPI.search import fts
+
+    def indexed():
+        return sorted(tuple(row) for row in db.session.query(
+            fts.c.rowid, fts.c.subject))
+
+    with app.app_context():
+        # As setup_db.py seeds scrimmages, outside any view
+        db.session.add(Scrimmage(subject='Seeded', scrimmage_type='Demo'))
+        db.session.commit()
+        assert indexed() == [(1, 'Seeded')]
+
+        Scrimmage.query.get(1).subject = 'Renamed'
+        db.session.commit()
+        assert indexed() == [(1, 'Renamed')]
+
+        db.session.delete(Scrimmage.query.get(1))
+        db.session.commit()
+        assert indexed() == []
+
+
+def test_search_index_rebuild(client):
+    from SSAPI.search import rebuild_index
+
+    token = login_client_helper(client, 'admin', 'admin')
+    create_scrimmage_helper(client, token, [2])
+    with app.app_context():
+        db.session.execute('DELETE FROM scrimmage_fts')
+        db.session.commit()
+        assert rebuild_index() == 1
+
+    rv = client.get('/Scrimmages/Search?q=test&all=true', headers=token)
+    assert [s['id'] for s in rv.get_json()] == [1]